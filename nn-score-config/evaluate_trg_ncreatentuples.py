@@ -1,16 +1,63 @@
 import uproot
-import pandas as pd
 import numpy as np
-import tensorflow as tf
 import os
+import sys
+import json
+import hashlib
 import argparse
+import queue
+import tempfile
+import threading
+from contextlib import ExitStack
 from sklearn.preprocessing import StandardScaler
 
-def main(analysis_type):
+# Input features are read through the shared memory-mapped cache in useful-scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "useful-scripts"))
+import column_cache
+# Scores are computed with the NumPy backend; TensorFlow is only imported to (re)export a model
+import numpy_inference
+
+# Events read, scaled and scored at a time; bounds the memory of both passes
+DEFAULT_CHUNK_SIZE = 1_000_000
+# Format of the <model>.scaler.json files that hold the fitted scaler next to each model
+SCALER_VERSION = 2
+# Scores of every (sample, category) slice, one <key>.npy per model, scaler and source file state
+SCORE_CACHE_DIR = "score_cache"
+# Chunks each pipeline stage may run ahead of the next one; 0 runs the stages one after the other
+DEFAULT_PIPELINE_DEPTH = 2
+
+def main(analysis_types, chunk_size=DEFAULT_CHUNK_SIZE, refit_scaler=False, threads=numpy_inference.DEFAULT_WORKERS,
+         score_cache_dir=SCORE_CACHE_DIR, pipeline_depth=DEFAULT_PIPELINE_DEPTH):
     """
     Processes source ntuples to create discriminant ntuples with correctly scaled inputs.
+
+    Works in two streaming passes over chunks of chunk_size events: the first
+    accumulates the scaler statistics, the second scales, scores and appends
+    the discriminants to the output trees. Memory is bounded by the chunk size,
+    not by the size of the full signal plus background dataset.
+
+    The fitted scaler is saved next to the model together with a fingerprint
+    of the model file, and the first pass is skipped while that fingerprint
+    still matches. It belongs to the model, so adding or changing a sample
+    does not refit it; refit_scaler forces a refit (which rescores every slice).
+
+    The scores of every (sample, category) slice are cached in score_cache_dir
+    under a hash of the model weights, the scaler and the source files. The
+    output files are assembled from cached slices plus freshly scored ones,
+    so adding or changing a mass point only costs scoring that point.
+
+    Reading, scoring and writing run as a pipeline: a reader thread fills the
+    next chunks and a scorer thread scales and scores them while the main
+    thread appends the results to the output trees, with at most
+    pipeline_depth chunks queued between stages. Throughput then approaches
+    the slowest stage instead of the sum of all of them.
+
+    Several analyses can be processed in one invocation. The background
+    samples they share are then read once per pass and each chunk is scored
+    with every model, while each analysis keeps its own scaler and output file.
     """
-    print(f"--- Starting NTuple processing for {analysis_type} with input scaling ---")
+    if isinstance(analysis_types, str): analysis_types = [analysis_types]
+    print(f"--- Starting NTuple processing for {' and '.join(analysis_types)} with input scaling ---")
 
     # --- Configuration ---
     NTUPLE_BASE_PATH = "/home/sgoswami/monobcntuples/local-samples/trf-workdir/SR/flattenedNTuples"
@@ -18,26 +65,31 @@ def main(analysis_type):
     CATEGORIES = ["c_tagged", "untagged"]
 
     # --- Analysis-Specific Settings ---
-    if analysis_type == 'LQ':
-        MODEL_PATH = "/home/sgoswami/monobcntuples/ML/best_model_lq.keras"
-        output_file = "discriminant_ntuples_lq_ctagged.root"
-        signal_files = {
-            "LQ_1p6TeV": f"{NTUPLE_BASE_PATH}/sig/lq/flat_tuple_lq_1p6TeV_merged_600K.root",
-            "LQ_2TeV":   f"{NTUPLE_BASE_PATH}/sig/lq/flat_tuple_lq_2TeV_merged_600K.root",
-            "LQ_2p4TeV": f"{NTUPLE_BASE_PATH}/sig/lq/flat_tuple_lq_2p4TeV_merged_600K.root",
-        }
-    elif analysis_type == 'DM':
-        MODEL_PATH = "/home/sgoswami/monobcntuples/ML/best_model_dm.keras"
-        output_file = "discriminant_ntuples_dm_ctagged.root"
-        # Names updated for consistency
-        signal_files = {
-            "DM_1p0TeV": f"{NTUPLE_BASE_PATH}/sig/dm/flat_tuple_yy_1p0TeV_qcd.root",
-            "DM_1p5TeV": f"{NTUPLE_BASE_PATH}/sig/dm/flat_tuple_yy_1p5TeV_qcd.root",
-            "DM_2p5TeV": f"{NTUPLE_BASE_PATH}/sig/dm/flat_tuple_yy_2p5TeV_qcd.root",
-        }
-    else:
-        print(f"FATAL: Unknown analysis type '{analysis_type}'. Use 'LQ' or 'DM'.")
-        return
+    ANALYSES = {
+        'LQ': {
+            "model_path": "/home/sgoswami/monobcntuples/ML/best_model_lq.keras",
+            "output_file": "discriminant_ntuples_lq_ctagged.root",
+            "signal_files": {
+                "LQ_1p6TeV": f"{NTUPLE_BASE_PATH}/sig/lq/flat_tuple_lq_1p6TeV_merged_600K.root",
+                "LQ_2TeV":   f"{NTUPLE_BASE_PATH}/sig/lq/flat_tuple_lq_2TeV_merged_600K.root",
+                "LQ_2p4TeV": f"{NTUPLE_BASE_PATH}/sig/lq/flat_tuple_lq_2p4TeV_merged_600K.root",
+            },
+        },
+        'DM': {
+            "model_path": "/home/sgoswami/monobcntuples/ML/best_model_dm.keras",
+            "output_file": "discriminant_ntuples_dm_ctagged.root",
+            # Names updated for consistency
+            "signal_files": {
+                "DM_1p0TeV": f"{NTUPLE_BASE_PATH}/sig/dm/flat_tuple_yy_1p0TeV_qcd.root",
+                "DM_1p5TeV": f"{NTUPLE_BASE_PATH}/sig/dm/flat_tuple_yy_1p5TeV_qcd.root",
+                "DM_2p5TeV": f"{NTUPLE_BASE_PATH}/sig/dm/flat_tuple_yy_2p5TeV_qcd.root",
+            },
+        },
+    }
+    for analysis_type in analysis_types:
+        if analysis_type not in ANALYSES:
+            print(f"FATAL: Unknown analysis type '{analysis_type}'. Use 'LQ' or 'DM'.")
+            return
 
     background_files = {
         "znunu": f"{NTUPLE_BASE_PATH}/bkg/flat_tuple_znunu_600K.root",
@@ -45,82 +97,354 @@ def main(analysis_type):
         "wjets": [f"{NTUPLE_BASE_PATH}/bkg/flat_tuple_wlnu.root"], # Assuming wlnu files might be combined
     }
 
-    all_samples = {**signal_files, **background_files}
+    # --- Step 1: Locate the input columns of every sample and category (shared backgrounds only once) ---
+    print("\nLocating input features...")
+    inputs = {}
+    analyses = []
+    for analysis_type in analysis_types:
+        analysis = {"type": analysis_type, **ANALYSES[analysis_type]}
+        analysis["all_samples"] = {**analysis["signal_files"], **background_files}
+        analysis["trees"] = []
+        for sample_name, path in analysis["all_samples"].items():
+            for category in CATEGORIES:
+                if (sample_name, category) not in inputs:
+                    inputs[(sample_name, category)] = load_features_from_files(path, category, FEATURES)
+                if inputs[(sample_name, category)]:
+                    analysis["trees"].append((sample_name, category))
+        if not analysis["trees"]:
+            print(f"FATAL: No data could be loaded for {analysis_type}. Exiting.")
+            return
+        analyses.append(analysis)
+    # Signals first, then the backgrounds, as every output file always had them
+    tree_order = ([key for key, columns in inputs.items() if columns and key[0] not in background_files]
+                  + [key for key, columns in inputs.items() if columns and key[0] in background_files])
 
-    # --- Step 1: Load all data from all files into a single DataFrame ---
-    print("\nLoading all data to determine scaling parameters...")
-    all_data_dfs = []
-    data_indices = {}
-    current_pos = 0
+    # --- Step 2: First pass, accumulate the scaling parameters chunk by chunk ---
+    to_fit = []
+    for analysis in analyses:
+        analysis["scaler_file"] = scaler_path(analysis["model_path"])
+        analysis["fingerprint"] = model_fingerprint(analysis["model_path"], FEATURES)
+        analysis["scaler"] = None if refit_scaler else load_scaler(analysis["scaler_file"], analysis["fingerprint"], FEATURES)
+        if analysis["scaler"] is not None:
+            print(f"\nReusing {analysis['type']} scaling parameters from {analysis['scaler_file']} "
+                  f"({int(analysis['scaler'].n_samples_seen_)} events).")
+        else:
+            analysis["scaler"] = StandardScaler()
+            to_fit.append(analysis)
 
-    for sample_name, path in all_samples.items():
-        for category in CATEGORIES:
-            df = load_features_from_files(path, category, FEATURES)
-            if df is not None and not df.empty:
-                all_data_dfs.append(df)
-                data_indices[(sample_name, category)] = (current_pos, current_pos + len(df))
-                current_pos += len(df)
+    if to_fit:
+        print(f"\nDetermining {' and '.join(a['type'] for a in to_fit)} scaling parameters in chunks of {chunk_size} events...")
+        for key in tree_order:
+            fitting = [analysis for analysis in to_fit if key in analysis["trees"]]
+            if not fitting: continue
+            for chunk in prefetch(iterate_feature_chunks(inputs[key], FEATURES, chunk_size, pipeline_depth + 2),
+                                  pipeline_depth):
+                for analysis in fitting:
+                    analysis["scaler"].partial_fit(chunk)
+        for analysis in to_fit:
+            total_events = int(getattr(analysis["scaler"], "n_samples_seen_", 0))
+            if total_events == 0:
+                print(f"FATAL: No data could be loaded for {analysis['type']}. Exiting.")
+                return
+            print(f"{analysis['type']}: Loaded a total of {total_events} events.")
+            save_scaler(analysis["scaler_file"], analysis["scaler"], analysis["fingerprint"], FEATURES)
 
-    if not all_data_dfs:
-        print("FATAL: No data could be loaded. Exiting.")
-        return
-
-    combined_df = pd.concat(all_data_dfs, ignore_index=True)
-    print(f"Loaded a total of {len(combined_df)} events.")
+    # --- Step 3: Load models ---
+    for analysis in analyses:
+        try:
+            analysis["model"] = load_model(analysis["model_path"])
+            analysis["model_hash"] = column_cache.file_fingerprint(numpy_inference.exported_path(analysis["model_path"]))
+        except Exception as e:
+            print(f"FATAL: Could not load model. Error: {e}")
+            return
 
-    # --- Step 2: Scale the features ---
-    print("\nScaling input features...")
-    scaler = StandardScaler()
-    scaled_features = scaler.fit_transform(combined_df[FEATURES])
+    # --- Step 4: Second pass, read, score and append each chunk to the output ROOT files as a pipeline ---
+    print(f"\nWriting scores to output file: {', '.join(analysis['output_file'] for analysis in analyses)}")
+    for analysis in analyses:
+        # The branch name depends on the analysis type
+        analysis["branch"] = f"discriminant_{analysis['type'].lower()}"
+        analysis["mean"] = analysis["scaler"].mean_.astype(np.float32)
+        analysis["scale"] = analysis["scaler"].scale_.astype(np.float32)
+    os.makedirs(score_cache_dir, exist_ok=True)
+    with ExitStack() as stack:
+        outputs = [stack.enter_context(uproot.recreate(analysis["output_file"])) for analysis in analyses]
 
-    # --- Step 3: Load model and get predictions ---
-    print(f"Loading Keras model from {MODEL_PATH}...")
-    try:
-        model = tf.keras.models.load_model(MODEL_PATH)
-    except Exception as e:
-        print(f"FATAL: Could not load Keras model. Error: {e}")
-        return
+        # Decide per slice which analyses are served from the score cache and which need scoring
+        plan = []
+        for sample_name, category in tree_order:
+            sources = inputs[(sample_name, category)]
+            entry = {
+                # CORRECTED: The TTree name should not have the extra suffix
+                "tree_name": f"{sample_name}_{category}",
+                "sources": sources,
+                "n_events": sum(len(columns[FEATURES[0]]) for columns in sources),
+                "cached": [],
+                "to_score": [],
+                "labels": [],
+            }
+            if entry["n_events"] == 0: continue
+            for analysis, f in zip(analyses, outputs):
+                if (sample_name, category) not in analysis["trees"]: continue
+                key = score_key(analysis["model_hash"], analysis["scaler"], FEATURES,
+                                analysis["all_samples"][sample_name], category)
+                score_file = os.path.join(score_cache_dir, f"{key}.npy")
+                cached = np.load(score_file, mmap_mode="r") if os.path.exists(score_file) else None
+                if cached is not None and len(cached) == entry["n_events"]:
+                    entry["cached"].append((analysis, f, cached))
+                    entry["labels"].append(f"{analysis['type']} cached")
+                else:
+                    entry["to_score"].append((analysis, f, score_file))
+                    entry["labels"].append(analysis["type"])
+            plan.append(entry)
 
-    print("Running model predictions on scaled data...")
-    all_predictions = model.predict(scaled_features, batch_size=4096)
-    all_discriminants = all_predictions.flatten()
+        # Reader and scorer threads feed the writer below; cached slices read no feature at all
+        messages = read_slices(plan, FEATURES, chunk_size, pipeline_depth + 2)
+        scored = score_slices(prefetch(messages, pipeline_depth), chunk_size, len(FEATURES), threads)
+        open_caches = []
+        try:
+            for kind, entry, scores in prefetch(scored, pipeline_depth):
+                if kind == "begin":
+                    for analysis, f, cached in entry["cached"]:
+                        for start in range(0, entry["n_events"], chunk_size):
+                            write_scores(f, entry["tree_name"], analysis["branch"],
+                                         np.asarray(cached[start:start + chunk_size]), start == 0)
+                    open_caches = [open_score_cache(score_file, entry["n_events"]) for _, _, score_file in entry["to_score"]]
+                    n_written = 0
+                elif kind == "chunk":
+                    for (analysis, f, _), (handle, _), discriminants in zip(entry["to_score"], open_caches, scores):
+                        write_scores(f, entry["tree_name"], analysis["branch"], discriminants, n_written == 0)
+                        handle.write(discriminants.astype("<f4", copy=False).tobytes())
+                    n_written += len(scores[0])
+                else:
+                    for (handle, tmp_path), (_, _, score_file) in zip(open_caches, entry["to_score"]):
+                        handle.close()
+                        os.replace(tmp_path, score_file)
+                    open_caches = []
+                    print(f"  -> Wrote {entry['n_events']} events to TTree '{entry['tree_name']}' ({', '.join(entry['labels'])})")
+        finally:
+            # An interrupted slice leaves no partial cache file behind
+            for handle, tmp_path in open_caches:
+                handle.close()
+                if os.path.exists(tmp_path): os.remove(tmp_path)
 
-    # --- Step 4: Write the results to the output ROOT file ---
-    print(f"\nWriting scores to output file: {output_file}")
-    with uproot.recreate(output_file) as f:
-        for (sample_name, category), (start, end) in data_indices.items():
-            discriminant_slice = all_discriminants[start:end]
+    for analysis in analyses:
+        print(f"\n--- Successfully created {analysis['output_file']} with correct score distributions ---")
 
-            # CORRECTED: The TTree name should not have the extra suffix
-            tree_name = f"{sample_name}_{category}"
+def load_model(model_path):
+    """
+    Load the NumPy export of a Keras model, (re)exporting it first if it is
+    missing or older than the model. Only an export imports TensorFlow.
+    """
+    weights_file = numpy_inference.exported_path(model_path)
+    if os.path.exists(model_path) and (not os.path.exists(weights_file)
+                                       or os.path.getmtime(weights_file) < os.path.getmtime(model_path)):
+        print(f"Exporting Keras model {model_path} to {weights_file}...")
+        max_difference = numpy_inference.export_keras_model(model_path, weights_file)
+        print(f"  Max score difference to Keras: {max_difference:.2e}")
+    print(f"Loading model weights from {weights_file}...")
+    return numpy_inference.load(weights_file)
 
-            # The branch name depends on the analysis type
-            discriminant_branch_name = f"discriminant_{analysis_type.lower()}"
+def score_key(model_hash, scaler, features_list, file_paths, category_name):
+    """Hash identifying the scores of one slice: model weights, scaler parameters and source trees."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({"model": model_hash, "features": features_list, "category": category_name,
+                              "mean": scaler.mean_.tolist(), "scale": scaler.scale_.tolist()}).encode())
+    if not isinstance(file_paths, list): file_paths = [file_paths]
+    for path in file_paths:
+        if os.path.exists(path):
+            digest.update(column_cache.file_fingerprint(path).encode())
+    return digest.hexdigest()
 
-            f[tree_name] = {discriminant_branch_name: discriminant_slice}
-            print(f"  -> Wrote {len(discriminant_slice)} events to TTree '{tree_name}'")
+def open_score_cache(path, n_events):
+    """
+    Start the .npy file of one slice's float32 scores. Returns (handle,
+    temporary path); the caller renames it to path once all scores are written.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    handle = os.fdopen(fd, "wb")
+    np.lib.format.write_array_header_1_0(handle, {"descr": "<f4", "fortran_order": False, "shape": (n_events,)})
+    return handle, tmp_path
 
-    print(f"\n--- Successfully created {output_file} with correct score distributions ---")
+def write_scores(f, tree_name, branch_name, scores, first):
+    """Create the output tree with the first chunk of a slice and extend it with the following ones."""
+    if first:
+        f[tree_name] = {branch_name: scores}
+    else:
+        f[tree_name].extend({branch_name: scores})
 
 def load_features_from_files(file_paths, category_name, features_list):
-    """Helper function to load a DataFrame for a given sample/category."""
+    """
+    Helper function returning the memory-mapped feature columns of a given
+    sample/category, one {feature: column} dict per file, or None on error.
+    """
     if not isinstance(file_paths, list): file_paths = [file_paths]
-    dfs = []
+    sources = []
     for path in file_paths:
         if not os.path.exists(path): continue
         try:
-            with uproot.open(path) as root_file:
-                if category_name in root_file:
-                    tree = root_file[category_name]
-                    if all(b in tree for b in features_list):
-                        dfs.append(tree.arrays(features_list, library="pd"))
+            trees = column_cache.tree_index(path)
+            if category_name in trees:
+                if all(b in trees[category_name]["branches"] for b in features_list):
+                    sources.append(column_cache.read_branches(path, category_name, features_list))
         except Exception as e:
             print(f"    ERROR processing {path}: {e}")
             return None
-    return pd.concat(dfs, ignore_index=True) if dfs else None
+    return sources or None
+
+def scaler_path(model_path):
+    """The scaler of a model is kept next to it, e.g. best_model_lq.keras -> best_model_lq.scaler.json."""
+    return f"{os.path.splitext(model_path)[0]}.scaler.json"
+
+def model_fingerprint(model_path, features_list):
+    """SHA-256 over the features and the content hash of the model (its NumPy export if the .keras is absent)."""
+    if not os.path.exists(model_path): model_path = numpy_inference.exported_path(model_path)
+    model = column_cache.file_fingerprint(model_path) if os.path.exists(model_path) else None
+    return hashlib.sha256(json.dumps({"features": features_list, "model": model}).encode()).hexdigest()
+
+def load_scaler(path, fingerprint, features_list):
+    """Return the saved StandardScaler if it was fitted on the same features and inputs, else None."""
+    try:
+        with open(path) as handle:
+            saved = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if saved.get("version") != SCALER_VERSION or saved.get("features") != features_list:
+        return None
+    if saved.get("fingerprint") != fingerprint:
+        print(f"\nModel changed since {path} was written, refitting the scaler.")
+        return None
+    scaler = StandardScaler()
+    scaler.n_features_in_ = len(features_list)
+    scaler.n_samples_seen_ = saved["n_samples_seen"]
+    scaler.mean_ = np.asarray(saved["mean"], dtype=np.float64)
+    scaler.var_ = np.asarray(saved["var"], dtype=np.float64)
+    scaler.scale_ = np.asarray(saved["scale"], dtype=np.float64)
+    return scaler
+
+def save_scaler(path, scaler, fingerprint, features_list):
+    """Write the fitted scaler next to the model; failing to do so only costs the reuse."""
+    saved = {
+        "version": SCALER_VERSION,
+        "features": features_list,
+        "mean": scaler.mean_.tolist(),
+        "var": scaler.var_.tolist(),
+        "scale": scaler.scale_.tolist(),
+        "n_samples_seen": int(scaler.n_samples_seen_),
+        "fingerprint": fingerprint,
+    }
+    try:
+        with open(f"{path}.part", "w") as handle:
+            json.dump(saved, handle, indent=1)
+        os.replace(f"{path}.part", path)
+        print(f"Saved scaling parameters to {path}")
+    except OSError as e:
+        print(f"WARNING: Could not save scaling parameters to {path}: {e}")
+
+def iterate_feature_chunks(sources, features_list, chunk_size, n_buffers=1):
+    """
+    Yield float32 (events, features) matrices of at most chunk_size events.
+
+    Each chunk is a view into one of n_buffers matrices allocated up front and
+    refilled in turn column by column straight from the memory-mapped branches,
+    with no intermediate DataFrames or float64 upcast. A chunk stays valid
+    until n_buffers more chunks have been requested, which lets a pipeline
+    stage run ahead of its consumer.
+    """
+    # Column-major, so every feature column is filled with one contiguous copy
+    matrices = [np.empty((chunk_size, len(features_list)), dtype=np.float32, order="F") for _ in range(n_buffers)]
+    n_chunks = 0
+    for columns in sources:
+        n_events = len(columns[features_list[0]])
+        for start in range(0, n_events, chunk_size):
+            chunk = matrices[n_chunks % n_buffers][:min(chunk_size, n_events - start)]
+            n_chunks += 1
+            for i, feature in enumerate(features_list):
+                chunk[:, i] = columns[feature][start:start + chunk_size]
+            yield chunk
+
+def read_slices(plan, features_list, chunk_size, n_buffers):
+    """Reader stage: ('begin', entry), the feature chunks of every slice that needs scoring, ('end', entry)."""
+    for entry in plan:
+        yield "begin", entry, None
+        if entry["to_score"]:
+            for chunk in iterate_feature_chunks(entry["sources"], features_list, chunk_size, n_buffers):
+                yield "chunk", entry, chunk
+        yield "end", entry, None
+
+def score_slices(messages, chunk_size, n_features, threads):
+    """Scorer stage: replaces every feature chunk by the scores of each analysis that needs them."""
+    # Scaling is done in float32 into a scratch matrix, so no float64 copy of a chunk is ever made
+    scaled = np.empty((chunk_size, n_features), dtype=np.float32, order="F")
+    for kind, entry, chunk in messages:
+        if kind != "chunk":
+            yield kind, entry, None
+            continue
+        scaled_chunk = scaled[:len(chunk)]
+        scores = []
+        for analysis, _, _ in entry["to_score"]:
+            np.subtract(chunk, analysis["mean"], out=scaled_chunk)
+            scaled_chunk /= analysis["scale"]
+            scores.append(analysis["model"].predict(scaled_chunk, workers=threads).flatten())
+        yield kind, entry, scores
+
+def prefetch(iterable, depth):
+    """
+    Run iterable on a background thread, at most depth items ahead of the
+    consumer. Exceptions are re-raised in the consumer; with depth 0 the
+    iterable is consumed directly.
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set(): break
+                items.put((item, None))
+            items.put((done, None))
+        except BaseException as e:
+            items.put((done, e))
+        finally:
+            # Let a generator upstream run its own cleanup (and stop its own producer) in this thread
+            if hasattr(iterable, "close"): iterable.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None: raise error
+            if item is done: return
+            yield item
+    finally:
+        stop.set()
+        # Unblock a producer waiting for space in the queue
+        while producer.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process ntuples with input scaling for LQ or DM analysis.")
-    parser.add_argument("--type", type=str, required=True, choices=['LQ', 'DM'], help="Type of analysis to run: 'LQ' or 'DM'")
+    parser.add_argument("--type", type=str, nargs="+", required=True, choices=['LQ', 'DM'],
+                        help="Type of analysis to run: 'LQ', 'DM', or both ('LQ DM') sharing the background reads")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Events scaled and scored at a time (default: {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument("--refit-scaler", action="store_true",
+                        help="Refit the input scaler on the current samples even if the one saved next to the model "
+                             "matches the model (rescores every slice)")
+    parser.add_argument("--threads", type=int, default=numpy_inference.DEFAULT_WORKERS,
+                        help=f"Threads scoring batches in parallel (default: {numpy_inference.DEFAULT_WORKERS})")
+    parser.add_argument("--score-cache", default=SCORE_CACHE_DIR,
+                        help=f"Directory caching the scores of every sample/category slice (default: {SCORE_CACHE_DIR})")
+    parser.add_argument("--pipeline-depth", type=int, default=DEFAULT_PIPELINE_DEPTH,
+                        help=f"Chunks read and scored ahead of the writer (default: {DEFAULT_PIPELINE_DEPTH}, 0 disables the pipeline)")
     args = parser.parse_args()
-    main(args.type)
+    main(list(dict.fromkeys(args.type)), args.chunk_size, args.refit_scaler, args.threads, args.score_cache,
+         args.pipeline_depth)
@@ -0,0 +1,280 @@
+"""
+NumPy inference backend for the Keras discriminant models.
+
+The LQ and DM discriminants are small feed-forward networks on four inputs.
+Loading them with TensorFlow costs many seconds and gigabytes of memory on
+every scoring job. export_keras_model() converts a saved .keras model once
+into a compact .npz file of float32 weights. load() turns that file into a
+NumpyModel, whose batched forward pass needs nothing but NumPy.
+
+TensorFlow is only imported by the export. The export also checks that both
+backends agree on random inputs before writing anything. NumpyModel.predict
+scores batches on a thread pool, one per CPU this process may run on. The
+BLAS library is limited to one thread while the pool runs, so the two do not
+oversubscribe the cores. The limit needs threadpoolctl; without it predict
+makes one forward pass over the whole input and leaves the threading to BLAS.
+
+Supported layers: Dense, BatchNormalization, Activation, ReLU and LeakyReLU.
+InputLayer, Dropout, GaussianNoise and Flatten are no-ops at inference. Any
+other layer makes the export fail. evaluate_trg_ncreatentuples.py exports
+automatically when the .npz is missing or older than the model. To export by
+hand:
+
+    python numpy_inference.py /path/to/best_model_lq.keras
+
+--benchmark EVENTS times the scoring of an exported model with one thread and
+with DEFAULT_WORKERS threads:
+
+    python numpy_inference.py /path/to/best_model_lq.numpy.npz --benchmark 1000000
+"""
+import os
+import json
+import time
+import argparse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+EXPORT_VERSION = 1
+DEFAULT_BATCH_SIZE = 16384
+# CPUs this process may run on, which can be fewer than the machine has (batch slots, taskset)
+DEFAULT_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+# Largest acceptable score difference between Keras and NumPy in the export check
+EXPORT_TOLERANCE = 1e-4
+# Layers that do nothing at inference on flat inputs
+PASSTHROUGH_LAYERS = {"InputLayer", "Dropout", "GaussianNoise", "Flatten"}
+# Keras defaults for activations given by name
+SELU_ALPHA = 1.6732632423543772
+SELU_SCALE = 1.0507009873554805
+LEAKY_RELU_SLOPE = 0.2
+
+
+def exported_path(model_path):
+    """The export of a model is kept next to it, e.g. best_model_lq.keras -> best_model_lq.numpy.npz."""
+    return f"{os.path.splitext(model_path)[0]}.numpy.npz"
+
+
+def _sigmoid(h):
+    # exp(-h) overflows to inf for very negative h, which correctly gives 0
+    with np.errstate(over="ignore"):
+        np.negative(h, out=h)
+        np.exp(h, out=h)
+    h += 1
+    return np.reciprocal(h, out=h)
+
+
+def _elu(h, alpha=1.0):
+    negative = h < 0
+    h[negative] = alpha * np.expm1(h[negative])
+    return h
+
+
+def _softmax(h):
+    h -= h.max(axis=1, keepdims=True)
+    np.exp(h, out=h)
+    h /= h.sum(axis=1, keepdims=True)
+    return h
+
+
+ACTIVATIONS = {
+    "linear": lambda h, **_: h,
+    "relu": lambda h, **_: np.maximum(h, 0, out=h),
+    "leaky_relu": lambda h, negative_slope=LEAKY_RELU_SLOPE, **_: np.maximum(h, negative_slope * h, out=h),
+    "sigmoid": lambda h, **_: _sigmoid(h),
+    "tanh": lambda h, **_: np.tanh(h, out=h),
+    "softmax": lambda h, **_: _softmax(h),
+    "softplus": lambda h, **_: np.logaddexp(0, h, out=h),
+    "elu": lambda h, alpha=1.0, **_: _elu(h, alpha),
+    "selu": lambda h, **_: np.multiply(_elu(h, SELU_ALPHA), SELU_SCALE, out=h),
+    "silu": lambda h, **_: np.multiply(h, _sigmoid(h.copy()), out=h),
+}
+ACTIVATIONS["swish"] = ACTIVATIONS["silu"]
+
+
+def _single_threaded_blas():
+    """Context limiting BLAS to one thread, or None if threadpoolctl is not available."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=1, user_api="blas")
+
+
+class NumpyModel:
+    """Feed-forward network of affine steps and activations, evaluated in float32."""
+
+    def __init__(self, steps):
+        # Each step is (kind, params, arrays); kind is 'dense', 'scale' (per-feature affine) or 'activation'
+        self.steps = steps
+
+    def _forward(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        h = x
+        for kind, params, arrays in self.steps:
+            if kind == "dense":
+                h = h @ arrays["kernel"]
+                h += arrays["bias"]
+                h = ACTIVATIONS[params["activation"]](h, **params)
+            elif kind == "scale":
+                h = h * arrays["multiplier"]
+                h += arrays["offset"]
+            else:
+                # Activations work in place, which must never touch the caller's input
+                h = ACTIVATIONS[params["activation"]](h.copy() if h is x else h, **params)
+        return h
+
+    def predict(self, x, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS):
+        """
+        Scores of an (events, inputs) matrix, computed in batches of batch_size
+        on workers threads with single-threaded BLAS. One forward pass over all
+        events is made instead when BLAS cannot be limited (no threadpoolctl).
+        """
+        n_events = len(x)
+        starts = range(0, n_events, batch_size)
+        blas_limit = _single_threaded_blas() if n_events and workers > 1 and len(starts) > 1 else None
+        if blas_limit is None:
+            return self._forward(x) if n_events else np.empty((0, self.n_outputs), dtype=np.float32)
+
+        output = np.empty((n_events, self.n_outputs), dtype=np.float32)
+
+        def run(start):
+            output[start:start + batch_size] = self._forward(x[start:start + batch_size])
+
+        with blas_limit, ThreadPoolExecutor(max_workers=min(workers, len(starts))) as pool:
+            list(pool.map(run, starts))
+        return output
+
+    @property
+    def n_outputs(self):
+        for kind, _, arrays in reversed(self.steps):
+            if kind == "dense":
+                return arrays["kernel"].shape[1]
+        raise ValueError("model has no Dense layer")
+
+    def save(self, path):
+        arrays = {}
+        config = []
+        for i, (kind, params, step_arrays) in enumerate(self.steps):
+            config.append({"kind": kind, "params": params, "arrays": sorted(step_arrays)})
+            arrays.update({f"{i}_{name}": array for name, array in step_arrays.items()})
+        arrays["config"] = np.array(json.dumps({"version": EXPORT_VERSION, "steps": config}))
+        tmp_path = f"{path}.part.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+
+def load(path):
+    """Read a NumpyModel written by export_keras_model()."""
+    with np.load(path, allow_pickle=False) as data:
+        config = json.loads(str(data["config"]))
+        if config.get("version") != EXPORT_VERSION:
+            raise ValueError(f"{path} was written by an incompatible export (version {config.get('version')})")
+        steps = [(step["kind"], step["params"],
+                  {name: np.ascontiguousarray(data[f"{i}_{name}"], dtype=np.float32) for name in step["arrays"]})
+                 for i, step in enumerate(config["steps"])]
+    return NumpyModel(steps)
+
+
+def _activation_params(activation):
+    name = getattr(activation, "__name__", str(activation))
+    if name not in ACTIVATIONS:
+        raise ValueError(f"activation '{name}' is not supported by the NumPy backend")
+    return {"activation": name}
+
+
+def _convert_layer(layer):
+    """Translate one Keras layer into NumpyModel steps."""
+    kind = type(layer).__name__
+    if kind in PASSTHROUGH_LAYERS:
+        return []
+    if kind == "Dense":
+        weights = layer.get_weights()
+        kernel = weights[0]
+        bias = weights[1] if len(weights) > 1 else np.zeros(kernel.shape[1])
+        return [("dense", _activation_params(layer.activation), {"kernel": kernel, "bias": bias})]
+    if kind == "BatchNormalization":
+        if layer.axis not in (-1, 1, [-1], [1]):
+            raise ValueError(f"BatchNormalization over axis {layer.axis} is not supported")
+        mean = np.asarray(layer.moving_mean)
+        gamma = np.asarray(layer.gamma) if layer.scale else np.ones_like(mean)
+        beta = np.asarray(layer.beta) if layer.center else np.zeros_like(mean)
+        multiplier = gamma / np.sqrt(np.asarray(layer.moving_variance) + layer.epsilon)
+        return [("scale", {}, {"multiplier": multiplier, "offset": beta - mean * multiplier})]
+    if kind == "Activation":
+        return [("activation", _activation_params(layer.activation), {})]
+    if kind == "ReLU" and not layer.max_value and not layer.threshold:
+        slope = float(layer.negative_slope)
+        return [("activation", {"activation": "leaky_relu", "negative_slope": slope} if slope else {"activation": "relu"}, {})]
+    if kind == "LeakyReLU":
+        slope = getattr(layer, "negative_slope", getattr(layer, "alpha", LEAKY_RELU_SLOPE))
+        return [("activation", {"activation": "leaky_relu", "negative_slope": float(slope)}, {})]
+    raise ValueError(f"layer '{layer.name}' of type {kind} is not supported by the NumPy backend")
+
+
+def export_keras_model(model_path, output_path=None, n_check=10000, seed=42):
+    """
+    Convert a saved Keras model into a NumpyModel file (default: exported_path(model_path)).
+
+    Both backends score n_check random standard-normal inputs, which is what
+    scaled features look like. The file is only written if the scores agree
+    within EXPORT_TOLERANCE. Returns the largest difference seen.
+    """
+    import tensorflow as tf
+
+    output_path = output_path or exported_path(model_path)
+    keras_model = tf.keras.models.load_model(model_path)
+    if len(keras_model.inputs) != 1 or len(keras_model.outputs) != 1:
+        raise ValueError("only single-input, single-output feed-forward models can be exported")
+    steps = []
+    for layer in keras_model.layers:
+        steps.extend((kind, params, {name: np.asarray(a, dtype=np.float32) for name, a in arrays.items()})
+                     for kind, params, arrays in _convert_layer(layer))
+    model = NumpyModel(steps)
+
+    n_inputs = keras_model.inputs[0].shape[-1]
+    x = np.random.default_rng(seed).standard_normal((n_check, n_inputs)).astype(np.float32)
+    expected = np.asarray(keras_model(x, training=False)).reshape(n_check, -1)
+    max_difference = float(np.max(np.abs(model.predict(x) - expected)))
+    if not max_difference <= EXPORT_TOLERANCE:
+        raise ValueError(f"NumPy and Keras scores of {model_path} differ by up to {max_difference:.2e}")
+    model.save(output_path)
+    return max_difference
+
+
+def benchmark_predict(model, n_events=1_000_000, repeat=3, seed=42):
+    """Print the scoring throughput of model on random inputs with one thread and with DEFAULT_WORKERS threads."""
+    n_inputs = next(arrays["kernel"].shape[0] for kind, _, arrays in model.steps if kind == "dense")
+    x = np.random.default_rng(seed).standard_normal((n_events, n_inputs)).astype(np.float32)
+    blas_limit = importlib.util.find_spec("threadpoolctl") is not None
+    print(f"Benchmarking prediction of {n_events} events, best of {repeat} "
+          f"({DEFAULT_WORKERS} usable CPUs, BLAS limit {'available' if blas_limit else 'not available'})")
+    results = {}
+    for workers in sorted({1, DEFAULT_WORKERS}):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results[workers] = model.predict(x, workers=workers)
+            best = min(best, time.perf_counter() - start)
+        print(f"  {workers:>3} thread(s): {best * 1e3:9.1f} ms, {n_events / best / 1e6:6.2f} M events/s")
+    if not np.allclose(results[1], results[DEFAULT_WORKERS], rtol=1e-5, atol=1e-6):
+        raise RuntimeError("scores differ between thread counts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Keras discriminant model for the NumPy inference backend.")
+    parser.add_argument("model", help="Saved Keras model (.keras), or an exported .npz with --benchmark")
+    parser.add_argument("-o", "--output", default=None, help="Output .npz file (default: next to the model)")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="EVENTS",
+                        help="Time the scoring of EVENTS random events with the exported model instead of exporting")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_predict(load(args.model if args.model.endswith(".npz") else exported_path(args.model)), args.benchmark)
+        return
+    output_path = args.output or exported_path(args.model)
+    max_difference = export_keras_model(args.model, output_path)
+    print(f"Exported {args.model} -> {output_path} (max score difference to Keras {max_difference:.2e})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
-import subprocess
+import argparse
 import os
+import sys
+
+# n_gen_ntuple comes from the shared yield index and the fits are run by the scheduler in useful-scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "useful-scripts"))
+import yield_index
+import trex_scheduler
 
 # --- Main Configuration ---
 # Tag to append to all jobs and outputs (e.g., '_ctagged', '_btagged')
 ANALYSIS_TAG = "_ctagged"
 SKELETON_CONFIG_PATH = "trf-config-hist.txt"
+# Flattened ntuples whose tree entries provide n_gen_ntuple (the values below are the fallback)
+NTUPLE_BASE_PATH = "/home/sgoswami/monobcntuples/local-samples/trf-workdir/SR/flattenedNTuples"
 
 # --- Calculation Constants ---
 ZNN_TARGET_YIELD = 702063.8
@@ -20,15 +28,15 @@ DM_MAGNIFICATION = {
 
 # --- Signal Point Metadata (for C-Tagging Analysis) ---
 SIGNAL_POINTS = [
-    {"name": "LQ_1p6TeV", "type": "LQ", "mass": "1.6 TeV", "xsec_pb": 0.13,    "n_gen_ntuple": 36504, "survived": 502915, "produced": 600000},
-    {"name": "LQ_2TeV",   "type": "LQ", "mass": "2 TeV",   "xsec_pb": 0.05,    "n_gen_ntuple": 35282, "survived": 500561, "produced": 600000},
-    {"name": "LQ_2p4TeV", "type": "LQ", "mass": "2.4 TeV", "xsec_pb": 0.03025, "n_gen_ntuple": 34319, "survived": 499548, "produced": 600000},
-    {"name": "DM_1p0TeV", "type": "DM", "mass": "1.0 TeV", "xsec_pb": 0.04,    "n_gen_ntuple": 12807, "survived": 100000, "produced": 100000},
-    {"name": "DM_1p5TeV", "type": "DM", "mass": "1.5 TeV", "xsec_pb": 0.001615,"n_gen_ntuple": 26885, "survived": 100000, "produced": 100000},
-    {"name": "DM_2p5TeV", "type": "DM", "mass": "2.5 TeV", "xsec_pb": 7.831e-6,"n_gen_ntuple": 52144, "survived": 100000, "produced": 100000},
+    {"name": "LQ_1p6TeV", "type": "LQ", "mass": "1.6 TeV", "xsec_pb": 0.13,    "n_gen_ntuple": 36504, "survived": 502915, "produced": 600000, "ntuple": "sig/lq/flat_tuple_lq_1p6TeV_merged_600K.root"},
+    {"name": "LQ_2TeV",   "type": "LQ", "mass": "2 TeV",   "xsec_pb": 0.05,    "n_gen_ntuple": 35282, "survived": 500561, "produced": 600000, "ntuple": "sig/lq/flat_tuple_lq_2TeV_merged_600K.root"},
+    {"name": "LQ_2p4TeV", "type": "LQ", "mass": "2.4 TeV", "xsec_pb": 0.03025, "n_gen_ntuple": 34319, "survived": 499548, "produced": 600000, "ntuple": "sig/lq/flat_tuple_lq_2p4TeV_merged_600K.root"},
+    {"name": "DM_1p0TeV", "type": "DM", "mass": "1.0 TeV", "xsec_pb": 0.04,    "n_gen_ntuple": 12807, "survived": 100000, "produced": 100000, "ntuple": "sig/dm/flat_tuple_yy_1p0TeV_qcd.root"},
+    {"name": "DM_1p5TeV", "type": "DM", "mass": "1.5 TeV", "xsec_pb": 0.001615,"n_gen_ntuple": 26885, "survived": 100000, "produced": 100000, "ntuple": "sig/dm/flat_tuple_yy_1p5TeV_qcd.root"},
+    {"name": "DM_2p5TeV", "type": "DM", "mass": "2.5 TeV", "xsec_pb": 7.831e-6,"n_gen_ntuple": 52144, "survived": 100000, "produced": 100000, "ntuple": "sig/dm/flat_tuple_yy_2p5TeV_qcd.root"},
 ]
 
-def main():
+def main(max_workers=trex_scheduler.DEFAULT_WORKERS):
     """
     Loops through all signal points, calculates the signal scale factor,
     generates a config, and runs TrexFitter.
@@ -42,6 +50,9 @@ def main():
         print(f"FATAL: Skeleton config not found at: {SKELETON_CONFIG_PATH}")
         return
 
+    ntuple_yields = yield_index.load_index(NTUPLE_BASE_PATH)
+
+    jobs = []
     for point in SIGNAL_POINTS:
         # Define the full name for this point including the analysis tag
         point_name_tagged = f"{point['name']}{ANALYSIS_TAG}"
@@ -60,7 +71,10 @@ def main():
         else: # It's a DM point
             magnification = DM_MAGNIFICATION.get(point['name'], 1.0) # Default to 1.0 if not found
 
-        base_sf = target_signal_yield / point["n_gen_ntuple"]
+        # Entries of the signal ntuple, from the yield index when it covers the file
+        n_gen_ntuple = yield_index.total_entries(ntuple_yields, point["ntuple"]) or point["n_gen_ntuple"]
+        print(f"  Signal ntuple entries: {n_gen_ntuple}")
+        base_sf = target_signal_yield / n_gen_ntuple
         final_sf = base_sf * magnification
         print(f"  Calculated signal scale factor: {final_sf:.8f}")
 
@@ -89,17 +103,15 @@ def main():
         print(f"Generated config: {config_filename}")
 
         command = ["trex-fitter", "hwdpf", config_filename]
-        print(f"Executing: {' '.join(command)}")
-
-        try:
-            subprocess.run(command, check=True, text=True)
-            print(f"--- Successfully completed {point_name_tagged} ---")
-        except subprocess.CalledProcessError as e:
-            print(f"--- ERROR: TRexFitter failed for {point_name_tagged} ---")
-            break
-        except FileNotFoundError:
-            print("\nERROR: 'trex-fitter' command not found. Is it in your PATH?")
-            break
+        jobs.append((point_name_tagged, command))
+
+    # --- Run the fits in parallel; a failing point does not stop the others ---
+    results = trex_scheduler.run_jobs(jobs, max_workers)
+    return all(result["status"] == "ok" for result in results)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generate the TRExFitter config of every signal point and run the fits.")
+    parser.add_argument("-j", "--jobs", type=int, default=trex_scheduler.DEFAULT_WORKERS,
+                        help=f"Fits run at the same time (default: {trex_scheduler.DEFAULT_WORKERS})")
+    args = parser.parse_args()
+    raise SystemExit(0 if main(args.jobs) else 1)
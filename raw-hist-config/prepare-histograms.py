@@ -1,15 +1,30 @@
 import uproot
 import numpy as np
 import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Flat-tuple columns are read through the shared memory-mapped cache in useful-scripts/, and
+# histograms are filled with the Hist1D engine from the same directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "useful-scripts"))
+import column_cache
+import yield_index
+from hist_engine import Hist1D
 
 # --- Main Configuration ---
 
 # 1. Base path to the original, c-tagged ntuples
 NTUPLE_BASE_PATH = "/home/sgoswami/monobcntuples/local-samples/trf-workdir/SR/flattenedNTuples"
 
-# 2. Variable to be histogrammed
+# 2. Histograms to be produced, as (name, variable, bin edges). Every variable of a tree is read in one
+#    pass and each spec is written as '<name>_<category>'. The --hist option replaces this list.
 VARIABLE_TO_HIST = "met_sig"
 HIST_BINS = np.linspace(0, 30, 16) # 15 bins from 0 to 30
+HIST_SPECS = [
+    (VARIABLE_TO_HIST, VARIABLE_TO_HIST, HIST_BINS),
+]
 
 # 3. File paths for all samples relative to the base path
 SAMPLE_PATHS = {
@@ -24,14 +39,16 @@ SAMPLE_PATHS = {
     "DM_2p5TeV": "sig/dm/flat_tuple_yy_2p5TeV_qcd.root",
 }
 
-# 4. Background Normalization Factors (scales raw c-tag yields to final expected yields)
-BACKGROUND_NORM_FACTORS = {
-    "znunu": 101.736,    # (702081.8 / 6901.0)
-    "wjets": 19876.78,   # (516796.4 / 26.0)
-    "ttbar": 499.29,     # (55421.2 / 111.0)
+# 4. Expected background yields (c_tagged + untagged). The normalization factor of each background is its
+#    expected yield divided by the raw entries of its ntuple, so it follows the sample size of the ntuple.
+BACKGROUND_EXPECTED_YIELDS = {
+    "znunu": 702081.8,
+    "wjets": 516796.4,
+    "ttbar": 55421.2,
 }
 
-# 5. Raw Background Yields from c-tagging ntuples
+# 5. Raw Background Yields from c-tagging ntuples. These are only the fallback: every run takes the tree
+#    entries of the current ntuples from the yield index (useful-scripts/yield_index.py) where available.
 BACKGROUND_YIELDS = {
     "tagged":   {"znunu": 121.0, "ttbar": 15.0, "wjets": 1.0},
     "untagged": {"znunu": 6780.0, "ttbar": 96.0, "wjets": 25.0}
@@ -59,106 +76,393 @@ SIGNAL_METADATA = {
     "DM_2p5TeV": {"type": "DM", "xsec_pb": 7.831e-6,"n_gen_ntuple": 52144, "survived": 100000, "produced": 100000},
 }
 
-def create_individual_histograms():
+# 8. Shape cache: each (sample, category, variable, binning) histogram is filled once per run and
+#    shared by both stages. It is also persisted here, keyed by the SHA-256 of the input ntuple, so
+#    unchanged ntuples are not re-read on the next run. Set to None to keep the cache in memory only.
+SHAPE_CACHE_FILE = "shape_cache.json"
+SHAPE_CACHE_VERSION = 2
+
+# 9. Per-event weight branch used when filling (e.g. "event_weight" from the flattener). None fills raw
+#    event counts. Either way every histogram carries its sum of squared weights as the bin errors.
+WEIGHT_BRANCH = None
+
+# 10. Entries per chunk when filling. Histograms are accumulated chunk by chunk, so memory use is bounded
+#     by the chunk size rather than by the size of the ntuple.
+CHUNK_SIZE = 1_000_000
+
+# 11. Incremental rebuilds: every output records in this manifest what it was built from (ntuple hashes,
+#     histogram specs, weight branch and the normalisation constants above). Outputs whose inputs are
+#     unchanged are skipped; --force rebuilds everything.
+HISTOGRAM_MANIFEST = "histograms_manifest.json"
+MANIFEST_VERSION = 1
+
+_shape_cache = {}
+_shape_cache_stats = {"filled": 0, "reused": 0}
+
+def load_shape_cache():
+    """Load persisted shapes from SHAPE_CACHE_FILE, if any."""
+    if not SHAPE_CACHE_FILE or not os.path.exists(SHAPE_CACHE_FILE):
+        return
+    try:
+        with open(SHAPE_CACHE_FILE) as f:
+            stored = json.load(f)
+        if stored.get("version") == SHAPE_CACHE_VERSION:
+            _shape_cache.update({key: Hist1D.from_dict(hist) for key, hist in stored["shapes"].items()})
+    except (OSError, ValueError) as e:
+        print(f"  WARNING: Could not read shape cache '{SHAPE_CACHE_FILE}': {e}. Starting empty.")
+
+def save_shape_cache():
+    """Write the shapes of this run back to SHAPE_CACHE_FILE."""
+    if not SHAPE_CACHE_FILE:
+        return
+    tmp_path = f"{SHAPE_CACHE_FILE}.part"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": SHAPE_CACHE_VERSION,
+                   "shapes": {key: hist.to_dict() for key, hist in _shape_cache.items()}}, f)
+    os.replace(tmp_path, SHAPE_CACHE_FILE)
+
+def load_manifest():
+    """Return {output file: dependencies} from HISTOGRAM_MANIFEST, or {} if it is missing or outdated."""
+    try:
+        with open(HISTOGRAM_MANIFEST) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return stored.get("outputs", {}) if stored.get("version") == MANIFEST_VERSION else {}
+
+def save_manifest(manifest):
+    tmp_path = f"{HISTOGRAM_MANIFEST}.part"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "outputs": manifest}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, HISTOGRAM_MANIFEST)
+
+def ntuple_fingerprint(process_name):
+    """SHA-256 of a sample's ntuple, or None if it does not exist."""
+    input_file = os.path.join(NTUPLE_BASE_PATH, SAMPLE_PATHS[process_name])
+    return column_cache.file_fingerprint(input_file) if os.path.exists(input_file) else None
+
+def histogram_settings(specs, weight_branch):
+    return {"specs": [[name, variable, [float(edge) for edge in bins]] for name, variable, bins in specs],
+            "weight_branch": weight_branch}
+
+def sample_dependencies(process_name, specs, weight_branch):
+    """Everything histo_<sample>.root depends on, in the JSON form stored in the manifest."""
+    return json.loads(json.dumps({"ntuple": ntuple_fingerprint(process_name), **histogram_settings(specs, weight_branch)}))
+
+def current_background_yields(files):
+    """BACKGROUND_YIELDS with each raw yield replaced by the tree entries recorded in the yield index, if any."""
+    yields = {}
+    for bkg_yields_category, category_yields in BACKGROUND_YIELDS.items():
+        tree_name = "c_tagged" if bkg_yields_category == "tagged" else "untagged"
+        yields[bkg_yields_category] = {}
+        for process, raw_yield in category_yields.items():
+            indexed = yield_index.entries(files, SAMPLE_PATHS[process], tree_name)
+            yields[bkg_yields_category][process] = float(indexed) if indexed is not None else raw_yield
+    return yields
+
+def background_norm_factors(background_yields):
+    """Scale each background's raw yields to BACKGROUND_EXPECTED_YIELDS (expected / raw c_tagged + untagged)."""
+    norm_factors = {}
+    for process, expected_yield in BACKGROUND_EXPECTED_YIELDS.items():
+        total_raw_yield = sum(category_yields.get(process, 0.0) for category_yields in background_yields.values())
+        norm_factors[process] = expected_yield / total_raw_yield if total_raw_yield > 0 else 0.0
+    return norm_factors
+
+def asimov_dependencies(point_name, point_meta, specs, weight_branch, background_yields, raw_counts):
+    """Everything asimov_histograms_<point>_ctagged.root depends on, in the JSON form stored in the manifest."""
+    backgrounds = sorted({process for category_yields in background_yields.values() for process in category_yields})
+    magnification = LQ_MAGNIFICATION if point_meta["type"] == "LQ" else DM_MAGNIFICATION.get(point_name, 1.0)
+    dependencies = {
+        "signal_ntuple": ntuple_fingerprint(point_name),
+        "background_ntuples": {process: ntuple_fingerprint(process) for process in backgrounds},
+        "signal_metadata": point_meta,
+        "magnification": magnification,
+        "background_yields": background_yields,
+        "signal_raw_counts": raw_counts,
+        "background_expected_yields": BACKGROUND_EXPECTED_YIELDS,
+        "background_norm_factors": background_norm_factors(background_yields),
+        "znn_target_yield": ZNN_TARGET_YIELD,
+        "bkg_xsec_pb": BKG_XSEC_PB,
+        "bkg_eff": BKG_EFF,
+        **histogram_settings(specs, weight_branch),
+    }
+    # Round-trip through JSON so the comparison with the manifest sees the same types
+    return json.loads(json.dumps(dependencies))
+
+def is_up_to_date(manifest, output_file, dependencies):
+    return os.path.exists(output_file) and manifest.get(output_file) == dependencies
+
+def parse_hist_spec(text):
+    """Parse '[NAME=]VAR:NBINS:LO:HI' or '[NAME=]VAR:EDGE,EDGE,...' into (name, variable, bin edges)."""
+    name, sep, rest = text.partition("=")
+    if not sep:
+        name, rest = None, text
+    variable, _, binning = rest.partition(":")
+    try:
+        fields = binning.split(":")
+        if len(fields) == 3:
+            bins = np.linspace(float(fields[1]), float(fields[2]), int(fields[0]) + 1)
+        elif len(fields) == 1 and "," in fields[0]:
+            bins = np.array([float(edge) for edge in fields[0].split(",")])
+        else:
+            raise ValueError("expected NBINS:LO:HI or a comma-separated list of edges")
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid histogram spec '{text}': {e}")
+    if not variable or len(bins) < 2 or np.any(np.diff(bins) <= 0):
+        raise argparse.ArgumentTypeError(f"invalid histogram spec '{text}': need a variable and increasing edges")
+    return (name or variable, variable, bins)
+
+def get_shapes(process_name, tree_name, specs, weight_branch=None, chunk_size=CHUNK_SIZE):
+    """
+    Histograms of one tree of a sample, as {spec name: Hist1D}.
+
+    Specs whose tree or branches do not exist are left out. Every histogram is
+    cached under (input hash, tree, variable, bin edges, weight branch). The
+    variables still missing from the cache are filled together in one pass
+    over the tree, chunk_size entries at a time.
+    """
+    input_file = os.path.join(NTUPLE_BASE_PATH, SAMPLE_PATHS[process_name])
+    if not os.path.exists(input_file):
+        return {}
+    fingerprint = column_cache.file_fingerprint(input_file)
+    keys = {}
+    for name, variable, bins in specs:
+        bins_key = ",".join(repr(float(edge)) for edge in bins)
+        keys[name] = f"{fingerprint}|{tree_name}|{variable}|{bins_key}|{weight_branch}"
+
+    shapes = {name: _shape_cache[key] for name, key in keys.items() if key in _shape_cache}
+    _shape_cache_stats["reused"] += len(shapes)
+    tree = column_cache.tree_index(input_file).get(tree_name)
+    if not tree or (weight_branch and weight_branch not in tree["branches"]):
+        return shapes
+    todo = [spec for spec in specs if spec[0] not in shapes and spec[1] in tree["branches"]]
+    if todo:
+        variables = sorted({variable for _, variable, _ in todo} | ({weight_branch} if weight_branch else set()))
+        filled = {name: Hist1D(bins) for name, _, bins in todo}
+        for chunk in column_cache.iterate_branches(input_file, tree_name, variables, chunk_size):
+            weights = chunk[weight_branch] if weight_branch else None
+            for name, variable, _ in todo:
+                filled[name].fill(chunk[variable], weights)
+        for name, _, _ in todo:
+            _shape_cache[keys[name]] = shapes[name] = filled[name]
+            _shape_cache_stats["filled"] += 1
+    return shapes
+
+def runs_in_pool(tasks, jobs):
+    return jobs > 1 and len(tasks) > 1
+
+def run_tasks(func, tasks, jobs):
+    """Run func(*task) for every task, in a pool of worker processes if jobs > 1. Results come back in task order."""
+    if not runs_in_pool(tasks, jobs):
+        for task in tasks:
+            yield func(*task)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=load_shape_cache) as pool:
+        yield from pool.map(func, *zip(*tasks))
+
+def histogram_sample(process_name, specs, weight_branch, chunk_size):
+    """
+    Stage 1 task: fill the shapes of one sample and write histo_<sample>.root.
+
+    Returns (log lines, shapes added to the cache, cache statistics) so that a
+    parent process can print the log in order and keep the shapes for stage 2.
+    """
+    messages = []
+    output_file = f"histo_{process_name}.root"
+    known_keys = set(_shape_cache)
+    stats_before = dict(_shape_cache_stats)
+    # Written under a temporary name so an interrupted run never leaves a truncated output behind
+    with uproot.recreate(f"{output_file}.part") as f_out:
+        for category, tree_name_in_file in [("c_tagged", "c_tagged"), ("untagged", "untagged")]:
+            shapes = get_shapes(process_name, tree_name_in_file, specs, weight_branch, chunk_size)
+            for name, _, _ in specs:
+                if name in shapes:
+                    # Save the raw, unscaled histogram with its sum of squared weights
+                    hist_name = f"{name}_{category}"
+                    f_out[hist_name] = shapes[name].to_TH1()
+                    messages.append(f"  -> Created '{hist_name}' in '{output_file}' (raw counts)")
+    os.replace(f"{output_file}.part", output_file)
+    new_shapes = {key: hist for key, hist in _shape_cache.items() if key not in known_keys}
+    stats = {key: _shape_cache_stats[key] - stats_before[key] for key in stats_before}
+    return messages, new_shapes, stats
+
+def create_individual_histograms(specs, weight_branch=None, chunk_size=CHUNK_SIZE, jobs=1, manifest=None, force=False):
     """Stage 1: Creates a separate histogram file for each MC process with raw event counts."""
     print("\n--- STAGE 1: Generating individual histograms for all MC samples ---")
+    manifest = {} if manifest is None else manifest
+    tasks = []
+    dependencies = {}
     for process_name, relative_path in SAMPLE_PATHS.items():
         input_file = os.path.join(NTUPLE_BASE_PATH, relative_path)
         output_file = f"histo_{process_name}.root"
         if not os.path.exists(input_file):
             print(f"  WARNING: Input file not found for '{process_name}': {input_file}. Skipping.")
             continue
+        dependencies[output_file] = sample_dependencies(process_name, specs, weight_branch)
+        if not force and is_up_to_date(manifest, output_file, dependencies[output_file]):
+            print(f"  -> '{output_file}' is up to date. Skipping.")
+            continue
+        tasks.append((process_name, specs, weight_branch, chunk_size))
+
+    for (process_name, *_), (messages, new_shapes, stats) in zip(tasks, run_tasks(histogram_sample, tasks, jobs)):
+        for message in messages:
+            print(message)
+        output_file = f"histo_{process_name}.root"
+        manifest[output_file] = dependencies[output_file]
+        if runs_in_pool(tasks, jobs):
+            # Shapes filled in a worker are handed back so that stage 2 does not read the ntuples again
+            _shape_cache.update(new_shapes)
+            for key, count in stats.items():
+                _shape_cache_stats[key] += count
+
+def build_asimov(point_name, point_meta, specs, shapes, raw_counts, background_yields, norm_factors):
+    """
+    Stage 2 task: combine the background shapes and the signal shape of one signal point
+    into asimov_histograms_<point>_ctagged.root.
+
+    shapes maps (process, tree) to {spec name: Hist1D}, so this never reads an ntuple.
+    Returns the log lines.
+    """
+    point_name_tagged = f"{point_name}_ctagged"
+    messages = [f"--- Processing Asimov for: {point_name_tagged} ---"]
+    output_hist_file = f"asimov_histograms_{point_name_tagged}.root"
+
+    # Calculate the total target signal yield
+    sig_eff = point_meta["survived"] / point_meta["produced"]
+    xsec_ratio = point_meta["xsec_pb"] / BKG_XSEC_PB
+    eff_ratio = sig_eff / BKG_EFF
+    target_signal_yield = ZNN_TARGET_YIELD * xsec_ratio * eff_ratio
+
+    # CORRECTED: Look up the correct magnification factor based on signal type and point name
+    if point_meta['type'] == 'LQ':
+        magnification = LQ_MAGNIFICATION
+    else: # It's a DM point
+        magnification = DM_MAGNIFICATION.get(point_name, 1.0) # Default to 1.0 if not found
+
+    final_signal_yield = target_signal_yield * magnification
+    total_raw_signal_events = sum(raw_counts.values())
+
+    with uproot.recreate(f"{output_hist_file}.part") as f_out:
+        for category, tree_name_in_file in [("c_tagged", "c_tagged"), ("untagged", "untagged")]:
+            asimov_hists = {name: Hist1D(bins) for name, _, bins in specs}
 
-        with uproot.open(input_file) as f_in, uproot.recreate(output_file) as f_out:
-            for category, tree_name_in_file in [("c_tagged", "c_tagged"), ("untagged", "untagged")]:
-                hist_name = f"{VARIABLE_TO_HIST}_{category}"
-                if tree_name_in_file in f_in and VARIABLE_TO_HIST in f_in[tree_name_in_file]:
-                    data = f_in[tree_name_in_file][VARIABLE_TO_HIST].array(library="np")
-                    shape_hist, _ = np.histogram(data, bins=HIST_BINS)
+            bkg_yields_category = "tagged" if category == "c_tagged" else "untagged"
 
-                    # Save the raw, unscaled histogram
-                    f_out[hist_name] = (shape_hist, HIST_BINS)
-                    print(f"  -> Created '{hist_name}' in '{output_file}' (raw counts)")
+            # Process Backgrounds
+            for process, raw_yield in background_yields[bkg_yields_category].items():
+                norm_factor = norm_factors.get(process, 1.0)
+                scaled_target_yield = raw_yield * norm_factor
 
-def create_asimov_data():
+                for name, shape_hist in shapes[(process, tree_name_in_file)].items():
+                    if shape_hist.integral() > 0:
+                        asimov_hists[name] += shape_hist.scaled(scaled_target_yield / shape_hist.integral())
+
+            # Process Signal
+            yield_fraction = raw_counts[category] / total_raw_signal_events if total_raw_signal_events > 0 else 0
+            yield_for_category = final_signal_yield * yield_fraction
+            for name, signal_shape_hist in shapes[(point_name, tree_name_in_file)].items():
+                if signal_shape_hist.integral() > 0:
+                    asimov_hists[name] += signal_shape_hist.scaled(yield_for_category / signal_shape_hist.integral())
+
+            # Write final Asimov histograms
+            for name, _, _ in specs:
+                hist_name = f"{name}_{category}"
+                if asimov_hists[name].integral() > 0:
+                    f_out[hist_name] = asimov_hists[name].to_TH1()
+                    messages.append(f"  -> Wrote final Asimov histogram '{hist_name}' to '{output_hist_file}'")
+                else:
+                    messages.append(f"  WARNING: Asimov histogram for '{hist_name}' is empty. Not writing.")
+    os.replace(f"{output_hist_file}.part", output_hist_file)
+    return messages
+
+def create_asimov_data(specs, weight_branch=None, chunk_size=CHUNK_SIZE, jobs=1, manifest=None, force=False):
     """Stage 2: Generates inflated Asimov data histograms for every signal point."""
     print("\n--- STAGE 2: Generating Asimov data for all signal points ---")
-    for point_name, point_meta in SIGNAL_METADATA.items():
-        point_name_tagged = f"{point_name}_ctagged"
-        print(f"--- Processing Asimov for: {point_name_tagged} ---")
-        output_hist_file = f"asimov_histograms_{point_name_tagged}.root"
-        if os.path.exists(output_hist_file):
-            os.remove(output_hist_file)
-
-        # Calculate the total target signal yield
-        sig_eff = point_meta["survived"] / point_meta["produced"]
-        xsec_ratio = point_meta["xsec_pb"] / BKG_XSEC_PB
-        eff_ratio = sig_eff / BKG_EFF
-        target_signal_yield = ZNN_TARGET_YIELD * xsec_ratio * eff_ratio
-
-        # CORRECTED: Look up the correct magnification factor based on signal type and point name
-        if point_meta['type'] == 'LQ':
-            magnification = LQ_MAGNIFICATION
-        else: # It's a DM point
-            magnification = DM_MAGNIFICATION.get(point_name, 1.0) # Default to 1.0 if not found
-
-        final_signal_yield = target_signal_yield * magnification
+    manifest = {} if manifest is None else manifest
+    # Raw yields come from the yield index (tree entries, metadata only) instead of hardcoded numbers
+    files = yield_index.load_index(NTUPLE_BASE_PATH)
+    background_yields = current_background_yields(files)
+    norm_factors = background_norm_factors(background_yields)
+    print(f"  Raw background yields: {background_yields}")
+    print(f"  Background normalization factors: {norm_factors}")
 
+    stale_points = []
+    point_raw_counts = {}
+    dependencies = {}
+    for point_name, point_meta in SIGNAL_METADATA.items():
         # Get the raw event counts for tagged/untagged split from the original ntuple
-        raw_counts = {}
-        total_raw_signal_events = 0
-        signal_ntuple_path = os.path.join(NTUPLE_BASE_PATH, SAMPLE_PATHS[point_name])
-        with uproot.open(signal_ntuple_path) as f_sig_in:
-            for cat, tree_name in [("c_tagged", "c_tagged"), ("untagged", "untagged")]:
-                tree = f_sig_in.get(tree_name)
-                raw_counts[cat] = tree.num_entries if tree else 0
-                total_raw_signal_events += raw_counts[cat]
-
-        with uproot.recreate(output_hist_file) as f_out:
-            for category, tree_name_in_file in [("c_tagged", "c_tagged"), ("untagged", "untagged")]:
-                hist_name = f"{VARIABLE_TO_HIST}_{category}"
-                asimov_hist = np.zeros(len(HIST_BINS) - 1, dtype=np.float64)
-
-                bkg_yields_category = "tagged" if category == "c_tagged" else "untagged"
-
-                # Process Backgrounds by reading their source ntuples
-                for process, raw_yield in BACKGROUND_YIELDS[bkg_yields_category].items():
-                    norm_factor = BACKGROUND_NORM_FACTORS.get(process, 1.0)
-                    scaled_target_yield = raw_yield * norm_factor
-
-                    ntuple_path = os.path.join(NTUPLE_BASE_PATH, SAMPLE_PATHS[process])
-                    if not os.path.exists(ntuple_path): continue
-                    with uproot.open(ntuple_path) as f_bkg_in:
-                        tree = f_bkg_in.get(tree_name_in_file)
-                        if tree and VARIABLE_TO_HIST in tree:
-                            data = tree[VARIABLE_TO_HIST].array(library="np")
-                            shape_hist, _ = np.histogram(data, bins=HIST_BINS)
-                            if np.sum(shape_hist) > 0:
-                                asimov_hist += (shape_hist / np.sum(shape_hist)) * scaled_target_yield
-
-                # Process Signal by reading its source ntuple
-                with uproot.open(signal_ntuple_path) as f_sig_in:
-                    tree = f_sig_in.get(tree_name_in_file)
-                    if tree and VARIABLE_TO_HIST in tree:
-                        signal_data = tree[VARIABLE_TO_HIST].array(library="np")
-                        signal_shape_hist, _ = np.histogram(signal_data, bins=HIST_BINS)
-                        if np.sum(signal_shape_hist) > 0:
-                            yield_fraction = raw_counts[category] / total_raw_signal_events if total_raw_signal_events > 0 else 0
-                            yield_for_category = final_signal_yield * yield_fraction
-                            asimov_hist += (signal_shape_hist / np.sum(signal_shape_hist)) * yield_for_category
-
-                # Write final Asimov histogram
-                if np.sum(asimov_hist) > 0:
-                    f_out[hist_name] = asimov_hist, HIST_BINS
-                    print(f"  -> Wrote final Asimov histogram '{hist_name}' to '{output_hist_file}'")
-                else:
-                    print(f"  WARNING: Asimov histogram for '{hist_name}' is empty. Not writing.")
+        point_raw_counts[point_name] = {cat: yield_index.entries(files, SAMPLE_PATHS[point_name], tree_name) or 0
+                                        for cat, tree_name in [("c_tagged", "c_tagged"), ("untagged", "untagged")]}
+        output_hist_file = f"asimov_histograms_{point_name}_ctagged.root"
+        dependencies[output_hist_file] = asimov_dependencies(point_name, point_meta, specs, weight_branch,
+                                                             background_yields, point_raw_counts[point_name])
+        if not force and is_up_to_date(manifest, output_hist_file, dependencies[output_hist_file]):
+            print(f"--- Asimov for {point_name}_ctagged is up to date. Skipping. ---")
+            continue
+        stale_points.append(point_name)
+    if not stale_points:
+        return
+
+    # Background shapes come from the shared cache, filled at most once per run and handed to every point
+    background_shapes = {}
+    for category_yields in background_yields.values():
+        for process in category_yields:
+            for tree_name in ["c_tagged", "untagged"]:
+                if (process, tree_name) not in background_shapes:
+                    background_shapes[(process, tree_name)] = get_shapes(process, tree_name, specs, weight_branch, chunk_size)
+
+    tasks = []
+    for point_name in stale_points:
+        shapes = dict(background_shapes)
+        for tree_name in ["c_tagged", "untagged"]:
+            shapes[(point_name, tree_name)] = get_shapes(point_name, tree_name, specs, weight_branch, chunk_size)
+        tasks.append((point_name, SIGNAL_METADATA[point_name], specs, shapes, point_raw_counts[point_name],
+                      background_yields, norm_factors))
+
+    for point_name, messages in zip(stale_points, run_tasks(build_asimov, tasks, jobs)):
+        for message in messages:
+            print(message)
+        output_hist_file = f"asimov_histograms_{point_name}_ctagged.root"
+        manifest[output_hist_file] = dependencies[output_hist_file]
 
-def main():
+def main(specs=None, weight_branch=WEIGHT_BRANCH, chunk_size=CHUNK_SIZE, jobs=1, force=False):
     """Main function to run all processing steps."""
-    create_individual_histograms()
-    create_asimov_data()
+    specs = specs or HIST_SPECS
+    names = [name for name, _, _ in specs]
+    if len(set(names)) != len(names):
+        print(f"FATAL: Histogram names must be unique, got {names}.")
+        return
+    load_shape_cache()
+    manifest = load_manifest()
+    try:
+        create_individual_histograms(specs, weight_branch, chunk_size, jobs, manifest, force)
+        create_asimov_data(specs, weight_branch, chunk_size, jobs, manifest, force)
+    finally:
+        # Record whatever was rebuilt, even if a later output failed
+        save_manifest(manifest)
+        save_shape_cache()
+    print(f"\n--- Shape cache: {_shape_cache_stats['filled']} histograms filled, "
+          f"{_shape_cache_stats['reused']} reused ---")
     print("\n--- All histograms created successfully. ---")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Create raw-count and Asimov histograms from the flattened ntuples.")
+    parser.add_argument("--hist", action="append", type=parse_hist_spec, default=None,
+                        metavar="[NAME=]VAR:NBINS:LO:HI",
+                        help="Histogram to produce, e.g. 'met_pt:20:0:1000' or 'dphi=jet1met_dphi:0,1,2,2.5,3.2'. "
+                             "Can be repeated; replaces HIST_SPECS.")
+    parser.add_argument("--weight-branch", default=WEIGHT_BRANCH,
+                        help="Branch with per-event weights to fill with, e.g. 'event_weight' "
+                             f"(default: {WEIGHT_BRANCH}, i.e. raw event counts)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help=f"Entries read and filled per chunk; bounds memory use (default: {CHUNK_SIZE})")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Worker processes for the per-sample stage 1 and per-point stage 2 (default: 1)")
+    parser.add_argument("--force", action="store_true",
+                        help=f"Rebuild every output, even those that {HISTOGRAM_MANIFEST} records as up to date")
+    args = parser.parse_args()
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    main(args.hist, args.weight_branch, args.chunk_size, args.jobs, args.force)
@@ -1,7 +1,16 @@
-import subprocess
+import argparse
 import re
+import os
+import sys
+
+# n_gen_ntuple comes from the shared yield index and the fits are run by the scheduler in useful-scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "useful-scripts"))
+import yield_index
+import trex_scheduler
 
 #Config
+# NtuplePaths of trf-config-ntup.txt; the tree entries of the signal ntuples there provide n_gen_ntuple
+NTUPLE_BASE_PATH = "/home/sgoswami/monobcntuples/local-samples/trf-workdir/SR/flattenedNTuples"
 ZNN_TARGET_YIELD = 702063.8
 BKG_XSEC_PB = 1063.2
 BKG_EFF = 1.0
@@ -22,7 +31,7 @@ signal_points = [
     {"name": "DM_2p5TeV", "type": "DM", "mass": "2.5 TeV", "xsec_pb": 7.831e-6,  "n_gen_ntuple": 52144, "survived": 100000, "produced": 100000, "ntuple_file": "./sig/dm/flat_tuple_yy_2p5_qcd"},
 ]
 
-def main():
+def main(max_workers=trex_scheduler.DEFAULT_WORKERS):
     try:
         with open("trf-config-ntup.txt", "r") as f:
             base_config = f.read()
@@ -30,6 +39,9 @@ def main():
         print("ERROR: skeleton-trf-config.txt not found. Please create it first.")
         return
 
+    ntuple_yields = yield_index.load_index(NTUPLE_BASE_PATH)
+
+    jobs = []
     for point in signal_points:
         print(f"\n{'='*50}\nProcessing: {point['name']}\n{'='*50}")
 
@@ -38,7 +50,10 @@ def main():
         xsec_ratio = point["xsec_pb"] / BKG_XSEC_PB
         eff_ratio = sig_eff / BKG_EFF
         target_signal_yield = ZNN_TARGET_YIELD * xsec_ratio * eff_ratio
-        base_sf = target_signal_yield / point["n_gen_ntuple"]
+        # Entries of the signal ntuple, from the yield index when it covers the file (hardcoded value otherwise)
+        n_gen_ntuple = yield_index.total_entries(ntuple_yields, f"{point['ntuple_file']}.root") or point["n_gen_ntuple"]
+        print(f"Signal ntuple entries: {n_gen_ntuple}")
+        base_sf = target_signal_yield / n_gen_ntuple
 
         if point["type"] == "LQ":
             final_sf = base_sf * LQ_MAGNIFICATION
@@ -64,17 +79,15 @@ def main():
         print(f"Generated config: {config_filename} with FINAL magnified SF = {final_sf:.8f}")
 
         command = ["trex-fitter", "nwdfp", config_filename]
-        print(f"Executing: {' '.join(command)}")
+        jobs.append((point["name"], command))
 
-        try:
-            subprocess.run(command, check=True, text=True)
-            print(f"--- Successfully completed {point['name']} ---")
-        except subprocess.CalledProcessError as e:
-            print(f"--- ERROR: TRexFitter failed for {point['name']} ---")
-            break
-        except FileNotFoundError:
-            print("\nERROR: 'trex-fitter' command not found.")
-            break
+    # --- Run the fits in parallel; a failing point does not stop the others ---
+    results = trex_scheduler.run_jobs(jobs, max_workers)
+    return all(result["status"] == "ok" for result in results)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generate the TRExFitter config of every signal point and run the fits.")
+    parser.add_argument("-j", "--jobs", type=int, default=trex_scheduler.DEFAULT_WORKERS,
+                        help=f"Fits run at the same time (default: {trex_scheduler.DEFAULT_WORKERS})")
+    args = parser.parse_args()
+    raise SystemExit(0 if main(args.jobs) else 1)
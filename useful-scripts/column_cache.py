@@ -0,0 +1,279 @@
+"""
+Memory-mapped column cache for the flattened ntuples.
+
+The first time a flat_tuple_*.root file is read, each requested branch is
+decompressed once and stored as an uncompressed .npy file. Later reads
+np.load() that file with mmap_mode='r'. Repeat runs then come straight from
+the page cache, and several processes on one node share the same pages.
+
+Layout: <cache dir>/<sha256 of the ROOT file>/<tree>/<branch>.npy. An
+index.json next to the trees records the entries and branch dtypes of every
+TTree in the file. Because entries are keyed by content hash, a rewritten
+ntuple simply gets a new entry. Stale entries can be removed with --prune.
+
+The cache directory is $FLAT_TUPLE_CACHE_DIR, or ~/.cache/flat-tuple-columns
+if that is unset. Point it at node-local disk when running on a cluster.
+
+Conversion streams the tree in chunks of step_size entries, so it never holds
+more than one chunk of a branch in memory. Consumers that must also stay
+bounded can use iterate_branches(), which hands out the cached columns
+chunk by chunk.
+
+Consumers (prepare-histograms.py, plot-inp-vars.py and
+evaluate_trg_ncreatentuples.py) use tree_index() and read_branches(). Running
+this file directly warms the cache for the files given on the command line:
+
+    python column_cache.py flattenedNTuples/bkg/*.root flattenedNTuples/sig/*/*.root
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import uproot
+
+CACHE_ENV = 'FLAT_TUPLE_CACHE_DIR'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'flat-tuple-columns')
+INDEX_NAME = 'index.json'
+FINGERPRINTS_NAME = 'fingerprints.json'
+CACHE_VERSION = 1
+DEFAULT_STEP_SIZE = 1_000_000
+
+_fingerprints = {}
+
+
+def cache_dir():
+    """Return the cache root, creating it if needed."""
+    path = os.environ.get(CACHE_ENV) or DEFAULT_CACHE_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _atomic_write(path, write):
+    """Write a file through a temporary file in the same directory, then rename it into place."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            write(handle)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _load_fingerprints():
+    path = os.path.join(cache_dir(), FINGERPRINTS_NAME)
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def file_fingerprint(path):
+    """
+    SHA-256 of a file's contents.
+
+    Hashing still has to read the whole file. The digest is therefore remembered
+    per (path, size, mtime), both in this process and in fingerprints.json
+    under the cache root, and only recomputed when the file changes.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    if not _fingerprints:
+        _fingerprints.update(_load_fingerprints())
+    known = _fingerprints.get(path)
+    if known and known[:2] == stamp:
+        return known[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+    sha = digest.hexdigest()
+
+    # Merge with whatever other processes have recorded since we loaded the file.
+    _fingerprints.update(_load_fingerprints())
+    _fingerprints[path] = stamp + [sha]
+    _atomic_write(os.path.join(cache_dir(), FINGERPRINTS_NAME),
+                  lambda handle: handle.write(json.dumps(_fingerprints, indent=1).encode()))
+    return sha
+
+
+def entry_dir(path):
+    """Cache directory holding the columns of one ROOT file."""
+    return os.path.join(cache_dir(), file_fingerprint(path))
+
+
+def _branch_path(entry, tree_name, branch):
+    return os.path.join(entry, tree_name, f'{branch}.npy')
+
+
+def _build_index(path):
+    """Record the entries and flat branch dtypes of every TTree in a ROOT file."""
+    index = {'version': CACHE_VERSION, 'source': os.path.abspath(path), 'trees': {}}
+    with uproot.open(path) as root_file:
+        for tree_name, classname in root_file.classnames(cycle=False).items():
+            if classname != 'TTree':
+                continue
+            tree = root_file[tree_name]
+            branches = {}
+            for name, branch in tree.items():
+                interpretation = branch.interpretation
+                # Only flat numeric branches map onto a single .npy column.
+                if isinstance(interpretation, uproot.AsDtype) and interpretation.to_dtype.shape == ():
+                    branches[name] = interpretation.to_dtype.str
+            index['trees'][tree_name] = {'num_entries': tree.num_entries, 'branches': branches}
+    return index
+
+
+def tree_index(path):
+    """
+    Return {tree name: {'num_entries': n, 'branches': {name: dtype}}} for a ROOT file.
+
+    This is built once per file from the ROOT metadata and kept in index.json.
+    After that, checking whether a tree or branch exists needs no ROOT I/O.
+    """
+    index_path = os.path.join(entry_dir(path), INDEX_NAME)
+    try:
+        with open(index_path) as handle:
+            index = json.load(handle)
+        if index.get('version') == CACHE_VERSION:
+            return index['trees']
+    except (OSError, ValueError):
+        pass
+    index = _build_index(path)
+    _atomic_write(index_path, lambda handle: handle.write(json.dumps(index, indent=1).encode()))
+    return index['trees']
+
+
+def _load_column(column_path):
+    # An empty array cannot be memory mapped, and there is nothing to share anyway.
+    column = np.load(column_path, mmap_mode='r')
+    return column if column.size else np.load(column_path)
+
+
+def _convert_branches(path, tree_name, branches, info, entry, step_size):
+    """Stream branches of one tree into .npy files, one chunk of step_size entries at a time."""
+    # Store in native byte order so consumers never pay for a byteswap.
+    dtypes = {b: np.dtype(info['branches'][b]).newbyteorder('=') for b in branches}
+    handles = {}
+    try:
+        for branch in branches:
+            column_path = _branch_path(entry, tree_name, branch)
+            os.makedirs(os.path.dirname(column_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(column_path), prefix='.tmp-')
+            handle = os.fdopen(fd, 'wb')
+            handles[branch] = (handle, tmp_path, column_path)
+            np.lib.format.write_array_header_1_0(handle, {
+                'descr': np.lib.format.dtype_to_descr(dtypes[branch]),
+                'fortran_order': False,
+                'shape': (info['num_entries'],),
+            })
+        with uproot.open(path) as root_file:
+            for arrays in root_file[tree_name].iterate(branches, step_size=step_size, library='np'):
+                for branch in branches:
+                    handles[branch][0].write(np.ascontiguousarray(arrays[branch], dtype=dtypes[branch]).tobytes())
+        for handle, tmp_path, column_path in handles.values():
+            handle.close()
+            os.replace(tmp_path, column_path)
+    except BaseException:
+        for handle, tmp_path, _ in handles.values():
+            handle.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+
+def read_branches(path, tree_name, branches, step_size=DEFAULT_STEP_SIZE):
+    """
+    Return {branch: read-only array} for the given branches of one tree.
+
+    Branches that are not cached yet are streamed from ROOT in one pass, in
+    chunks of step_size entries, and written out. Every array returned is a
+    memory map of its .npy file, so nothing is loaded until it is touched.
+    Raises KeyError if the tree or a branch is missing or not a flat column.
+    """
+    trees = tree_index(path)
+    if tree_name not in trees:
+        raise KeyError(f"TTree '{tree_name}' not found in {path}")
+    available = trees[tree_name]['branches']
+    unknown = [b for b in branches if b not in available]
+    if unknown:
+        raise KeyError(f"Branches {unknown} not found as flat columns in {path}:{tree_name}")
+
+    entry = entry_dir(path)
+    missing = [b for b in branches if not os.path.exists(_branch_path(entry, tree_name, b))]
+    if missing:
+        _convert_branches(path, tree_name, missing, trees[tree_name], entry, step_size)
+
+    return {branch: _load_column(_branch_path(entry, tree_name, branch)) for branch in branches}
+
+
+def iterate_branches(path, tree_name, branches, step_size=DEFAULT_STEP_SIZE):
+    """
+    Yield {branch: array} chunks of at most step_size entries covering one tree.
+
+    The chunks are slices of the memory-mapped columns. A consumer that drops
+    each chunk before taking the next only ever holds one chunk in memory, and
+    the pages behind it stay in the shared page cache.
+    """
+    columns = read_branches(path, tree_name, branches, step_size)
+    num_entries = tree_index(path)[tree_name]['num_entries']
+    for start in range(0, num_entries, step_size):
+        yield {branch: column[start:start + step_size] for branch, column in columns.items()}
+
+
+def warm(path, trees=None, step_size=DEFAULT_STEP_SIZE):
+    """Convert every flat branch of the given trees (default: all) into the cache."""
+    index = tree_index(path)
+    for tree_name in trees or index:
+        if tree_name in index:
+            read_branches(path, tree_name, list(index[tree_name]['branches']), step_size)
+    return index
+
+
+def prune(keep_paths):
+    """Remove cache entries whose source file no longer hashes to them."""
+    root = cache_dir()
+    live = {file_fingerprint(p) for p in keep_paths if os.path.exists(p)}
+    removed = 0
+    for name in os.listdir(root):
+        entry = os.path.join(root, name)
+        if os.path.isdir(entry) and name not in live:
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm the memory-mapped column cache for flattened ntuples.')
+    parser.add_argument('files', nargs='+', help='flat_tuple_*.root files to convert')
+    parser.add_argument('--tree', action='append', default=None,
+                        help='Only convert this tree (can be repeated). Default: all trees.')
+    parser.add_argument('--step-size', type=int, default=DEFAULT_STEP_SIZE,
+                        help=f'Entries read from ROOT per chunk during conversion (default: {DEFAULT_STEP_SIZE})')
+    parser.add_argument('--prune', action='store_true',
+                        help='Afterwards remove cache entries that do not belong to any of the given files')
+    args = parser.parse_args()
+
+    print(f"Column cache: {cache_dir()}")
+    for path in args.files:
+        if not os.path.exists(path):
+            print(f"  WARNING: {path} not found. Skipping.")
+            continue
+        index = warm(path, args.tree, args.step_size)
+        summary = ', '.join(f"{name} ({info['num_entries']} entries)" for name, info in index.items())
+        print(f"  -> {path}: {summary}")
+    if args.prune:
+        print(f"Pruned {prune(args.files)} stale cache entries.")
+
+
+if __name__ == '__main__':
+    main()
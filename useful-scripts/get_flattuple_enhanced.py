@@ -1,29 +1,262 @@
 #!/usr/bin/env python3
 """
 Process all Delphes ROOT files starting with 'delphes_' in the current directory.
-For each file, write out flat ntuples for events that pass the following selections:
+For each file, write out flat ntuples for events that pass the cuts listed in
+SELECTION_CUTS, by default:
   * At least two jets.
+  * Missing ET (MET) >= 200 GeV.
   * Leading jet (jet1) has pT >= 150 GeV and |eta| <= 2.4.
   * Subleading jet (jet2) has pT >= 30 GeV and |eta| <= 2.8.
-  * Missing ET (MET) >= 200 GeV.
+Cuts can be changed or added with --cut NAME=EXPRESSION or --cuts-file, and a
+cutflow table is printed for every file.
 
 Output files are named by replacing the 'delphes' prefix with 'flat_tuple',
 for example 'delphes_sample.root' becomes 'flat_tuple_sample.root'.
+
+By default each input tree is read in one go. Pass --step-size to stream the
+input in chunks instead, either as a number of events (e.g. 100000) or as a
+memory size (e.g. "200 MB"). Each chunk is selected, split and appended to the
+output trees, so peak memory is set by the chunk size, not by the file size.
+
+Cuts that only use event-level variables (MET, HT, the Jet_size counter, ...)
+are evaluated first. The jet collections are then only read (basket by basket)
+and searched for the leading jets where events survive.
+
+Pass --jobs N to flatten N input files at a time in separate worker processes.
+A file that fails is reported and skipped; the other files are still written.
+
+Systematic variations are produced from the same read of the input: each
+--variation NAME:KEY=VALUE[,KEY=VALUE] (e.g. "JES_up:jet_pt_scale=1.05" or
+"MET_res:met_smear=0.1") gets its own c_tagged_NAME/untagged_NAME trees next to
+the nominal c_tagged/untagged ones. Smearing is reproducible per event for a
+given --seed, independent of the chunking and of the number of workers.
+jet_pt_scale scales HT along with the jet pT and met_sig follows, but the MET
+is left as is; combine it with met_scale to move the MET too.
+
+Jets can also be re-tagged at flattening time from Jet.Flavor and Jet.PT:
+every --retag NAME:PARAMETRISATION[,c=SCALE][,b=SCALE][,light=SCALE] draws a
+per-jet Bernoulli decision from the efficiency curves in
+TAGGER_PARAMETRISATIONS (optionally scaled per flavour) and adds nCjets_NAME
+and ctag_NAME branches, so tagger working points can be scanned without
+rerunning Delphes. The draws are seeded by --seed like the MET smearing.
+
+The output codec is chosen with --compression (e.g. "lz4:1", "zstd:5", "none";
+default "zlib:1", uproot's own default) and --basket-entries sets the number of
+events per output basket. --benchmark-compression FLAT_TUPLE rewrites an
+existing flat tuple with a range of settings and reports write time, file size
+and read-back time for each.
+
+A manifest (flatten_manifest.json) next to the outputs records the size and
+mtime of each input (plus its SHA-256 with --hash), the selection settings and
+FLATTENER_VERSION. On a rerun only the outputs whose input or settings changed
+are rebuilt; --force rebuilds everything. The manifest is saved after every
+finished file, so an interrupted run resumes with the files it had not done.
 """
 
 import os
 import glob
+import json
 import math
+import time
+import hashlib
+import tempfile
+import zlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import uproot
 import awkward as ak
 
 
-def compute_leading_jets(jets_pt, jets_eta, jets_phi, jets_flavor):
+# Bump whenever a code change alters the content of the flat tuples, so that
+# the manifest marks all existing outputs as stale.
+FLATTENER_VERSION = 1
+
+# Name of the manifest written next to the outputs
+MANIFEST_NAME = 'flatten_manifest.json'
+
+# Settings that do not change the output content (left out of the manifest)
+RUNTIME_SETTINGS = ['step_size', 'output_dir']
+
+# Jet collections read from the Delphes tree
+JET_BRANCHES = ['Jet.PT', 'Jet.Eta', 'Jet.Phi', 'Jet.Flavor']
+
+# Event-level quantities (one entry per event)
+EVENT_BRANCHES = ['MissingET.MET', 'MissingET.Phi', 'ScalarHT.HT',
+                  'Event.CrossSection', 'Event.Weight']
+
+# Jet multiplicity counter of the Jet collection
+JET_COUNTER = 'Jet_size'
+
+# Per-jet tag bit written by the Delphes tagging module
+TAG_BRANCH = 'Jet.BTag'
+
+# Branch types of the c_tagged/untagged output trees
+OUTPUT_TYPES = {
+    'jet1_pt': 'float32',
+    'jet2_pt': 'float32',
+    'jet1_eta': 'float32',
+    'jet2_eta': 'float32',
+    'jet1_phi': 'float32',
+    'jet2_phi': 'float32',
+    'met_pt': 'float32',
+    'jet1met_dphi': 'float32',
+    'met_sig': 'float32',
+    'nJets': 'int32',
+    'nCjets': 'int32',
+    'event_xsec': 'float32',
+    'event_weight': 'float32',
+}
+
+# Shifts a variation may apply: jet_pt_scale multiplies every jet pT and HT
+# (the MET is not recomputed from the jets), met_scale multiplies the MET and
+# met_smear is a relative Gaussian MET resolution. The nominal selection is
+# always written as well.
+VARIATION_SHIFTS = {'jet_pt_scale': 1.0, 'met_scale': 1.0, 'met_smear': 0.0}
+DEFAULT_SEED = 12345
+
+
+def eff_light_jet(pt):
+    """Efficiency formula for light-flavor jets (mistag rate)."""
+    return 0.002 + 7.3e-06 * pt
+
+def eff_c_jet(pt):
+    """Efficiency formula for c-jets (mistag rate)."""
+    return 0.20 * np.tanh(0.02 * pt) * (1 / (1 + 0.0034 * pt))
+
+def eff_b_jet(pt):
+    """Efficiency formula for b-jets."""
+    return 0.80 * np.tanh(0.003 * pt) * (30 / (1 + 0.086 * pt))
+
+
+# Tag efficiency parametrisations for --retag, as (light, c, b) functions of
+# the jet pT. 'delphes' is the parametrisation of the Delphes card, as drawn by
+# plot-tagging-profile.py.
+TAGGER_PARAMETRISATIONS = {
+    'delphes': (eff_light_jet, eff_c_jet, eff_b_jet),
+}
+
+# Output codecs accepted by --compression, as "name:level" (or "none")
+COMPRESSION_CODECS = {'zlib': uproot.ZLIB, 'lz4': uproot.LZ4, 'zstd': uproot.ZSTD, 'lzma': uproot.LZMA}
+DEFAULT_COMPRESSION = 'zlib:1'
+
+# Settings compared by --benchmark-compression
+BENCHMARK_COMPRESSIONS = ['none', 'lz4:1', 'lz4:9', 'zstd:1', 'zstd:5', 'zlib:1', 'zlib:6', 'lzma:1']
+BENCHMARK_BASKET_ENTRIES = [10_000, 100_000, None]
+
+# Event selection: an ordered list of [name, expression] cuts. Expressions are
+# evaluated on the variables below and may use the functions in CUT_FUNCTIONS.
+SELECTION_CUTS = [
+    ['two_jets', 'nJets >= 2'],
+    ['met',      'met_pt >= 200'],
+    ['jet1_pt',  'jet1_pt >= 150'],
+    ['jet1_eta', 'abs(jet1_eta) <= 2.4'],
+    ['jet2_pt',  'jet2_pt >= 30'],
+    ['jet2_eta', 'abs(jet2_eta) <= 2.8'],
+]
+
+# Variables known before the jet collections are read
+EVENT_VARIABLES = ['nJets', 'met_pt', 'met_phi', 'met_sig', 'ht', 'event_xsec', 'event_weight']
+
+# Variables that need the jet collections (defined for events with >= 2 jets)
+JET_VARIABLES = ['jet1_pt', 'jet2_pt', 'jet1_eta', 'jet2_eta', 'jet1_phi', 'jet2_phi',
+                 'jet1_flavor', 'jet1met_dphi', 'nCjets']
+
+CUT_FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'minimum': np.minimum, 'maximum': np.maximum}
+
+
+def jagged_buffers(jagged):
+    """
+    Return the flat content of a one-level jagged array together with the
+    start and stop of each event's list in that content, without copying.
+    """
+    layout = ak.to_layout(jagged)
+    if isinstance(layout, ak.contents.ListArray):
+        starts, stops = layout.starts, layout.stops
+    else:
+        layout = layout.to_ListOffsetArray64(False)
+        starts, stops = layout.offsets[:-1], layout.offsets[1:]
+    return layout.content.data, np.asarray(starts), np.asarray(stops)
+
+
+def leading_two_positions(content, starts, counts):
+    """
+    Single pass over the jet slots of every event: return the position (within
+    each event) of the highest and second-highest value of content. All events
+    must have at least two entries. Ties go to the earlier entry, as in a
+    stable descending sort.
+    """
+    best1 = content[starts]
+    best2 = content[starts + 1]
+    swap = best2 > best1
+    first = swap.astype(np.int64)
+    second = 1 - first
+    best1, best2 = np.where(swap, best2, best1), np.where(swap, best1, best2)
+
+    events = np.flatnonzero(counts > 2)
+    slot = 2
+    while len(events):
+        value = content[starts[events] + slot]
+
+        # New leading value: the old leading entry becomes the subleading one
+        is_first = value > best1[events]
+        ev1 = events[is_first]
+        second[ev1] = first[ev1]
+        best2[ev1] = best1[ev1]
+        first[ev1] = slot
+        best1[ev1] = value[is_first]
+
+        # New subleading value only
+        is_second = ~is_first & (value > best2[events])
+        ev2 = events[is_second]
+        second[ev2] = slot
+        best2[ev2] = value[is_second]
+
+        slot += 1
+        events = events[counts[events] > slot]
+    return first, second
+
+
+def compute_leading_jets(jets_pt, jets_eta, jets_phi, jets_flavor, rows=None):
+    """
+    Find events that have at least two jets and return arrays for the leading
+    and subleading jets (by pT) along with a mask for the events that passed
+    the two-jet requirement. The top two jets are found directly on the flat
+    jet buffers, without sorting or copying the jet collections.
+
+    If rows is given, only those events (indices into the jet arrays) are
+    considered and the returned mask runs over rows.
+    """
+    pt_content, pt_starts, pt_stops = jagged_buffers(jets_pt)
+    if rows is None:
+        rows = np.arange(len(pt_starts))
+
+    # Build a mask for events with two or more jets
+    n_jets = pt_stops[rows] - pt_starts[rows]
+    mask_two_jets = n_jets >= 2
+    selected = rows[mask_two_jets]
+
+    # Position of the leading (first) and subleading (second) jet in each event
+    first, second = leading_two_positions(pt_content, pt_starts[selected], n_jets[mask_two_jets])
+
+    def pick(jagged):
+        content, starts, _ = jagged_buffers(jagged)
+        starts = starts[selected]
+        return content[starts + first], content[starts + second]
+
+    pt1, pt2 = pick(jets_pt)
+    eta1, eta2 = pick(jets_eta)
+    phi1, phi2 = pick(jets_phi)
+    flavor1, _ = pick(jets_flavor)
+
+    return pt1, pt2, eta1, eta2, phi1, phi2, mask_two_jets, flavor1
+
+
+def compute_leading_jets_argsort(jets_pt, jets_eta, jets_phi, jets_flavor):
     """
-    Find events that have at least two jets, sort jets by pT in descending order,
-    and return arrays for the leading and subleading jets along with a mask
-    for the events that passed the two-jet requirement.
+    Reference implementation of compute_leading_jets that fully sorts the jets
+    of every event. Only used by --benchmark-leading-jets.
     """
     # Build a mask for events with two or more jets
     mask_two_jets = ak.num(jets_pt, axis=1) >= 2
@@ -63,6 +296,40 @@ def compute_leading_jets(jets_pt, jets_eta, jets_phi, jets_flavor):
     )
 
 
+def benchmark_leading_jets(n_events=1_000_000, repeat=3, seed=42):
+    """
+    Time compute_leading_jets against the full-argsort reference on a random
+    sample of n_events Delphes-like events and check that both agree.
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(4.0, n_events)
+    n_total = int(counts.sum())
+    def jagged(values):
+        return ak.unflatten(values, counts)
+    jets_pt = jagged(rng.exponential(80.0, n_total).astype(np.float32) + 20.0)
+    jets_eta = jagged(rng.normal(0.0, 2.0, n_total).astype(np.float32))
+    jets_phi = jagged(rng.uniform(-math.pi, math.pi, n_total).astype(np.float32))
+    jets_flavor = jagged(rng.choice([0, 4, 5, 21], n_total).astype(np.int32))
+    args = (jets_pt, jets_eta, jets_phi, jets_flavor)
+
+    print(f"Benchmarking leading-jet selection on {n_events} events ({n_total} jets), best of {repeat}")
+    timings = {}
+    results = {}
+    for name, func in [('argsort', compute_leading_jets_argsort), ('top-2 kernel', compute_leading_jets)]:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results[name] = func(*args)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+        print(f"  {name:<14}: {best * 1e3:9.1f} ms")
+
+    for ref, new in zip(results['argsort'], results['top-2 kernel']):
+        if not np.array_equal(ref, new):
+            raise RuntimeError("top-2 kernel and argsort results differ")
+    print(f"  Outputs identical, speedup x{timings['argsort'] / timings['top-2 kernel']:.1f}")
+
+
 def compute_dphi(phi1, phi2):
     """
     Compute the absolute difference in phi between two angles,
@@ -72,141 +339,835 @@ def compute_dphi(phi1, phi2):
     return np.abs(delta)
 
 
-def process_file(input_path):
-    # Prepare the output filename
-    filename = os.path.basename(input_path)
-    output_name = filename.replace('delphes', 'flat_tuple', 1)
-    print(f"Reading {filename} and writing {output_name}")
+def parse_step_size(value):
+    """
+    Interpret a --step-size argument: plain integers are a number of events,
+    anything else (e.g. "200 MB") is passed to uproot as a memory size.
+    """
+    return int(value) if value.isdigit() else value
 
-    # Open the ROOT file and access the Delphes tree
-    root_file = uproot.open(input_path)
-    tree = root_file['Delphes']
 
-    # Load jet variables
-    jets_pt  = tree['Jet.PT'].array(library='ak')
-    jets_eta = tree['Jet.Eta'].array(library='ak')
-    jets_phi = tree['Jet.Phi'].array(library='ak')
-    jets_flavor = tree['Jet.Flavor'].array(library='ak')
+def read_jets(tree, expressions, entries, entry_offsets, entry_start, entry_stop):
+    """
+    Read the jet branches for the given (sorted) tree entries of the chunk
+    [entry_start, entry_stop) only. Whole baskets are the unit of
+    decompression, so only the baskets that contain at least one requested
+    entry are read. Returns the jet arrays, the row of each requested entry in
+    them and the (start, stop) entry ranges that were read.
+    """
+    entry_offsets = np.asarray(entry_offsets)
+    baskets = np.unique(np.searchsorted(entry_offsets, entries, side='right') - 1)
 
-    # Load MET and HT
-    met_ak     = tree['MissingET.MET'].array(library='ak')
-    met_phi_ak = tree['MissingET.Phi'].array(library='ak')
-    ht_ak      = tree['ScalarHT.HT'].array(library='ak')
+    # Merge neighbouring baskets into contiguous entry ranges within the chunk
+    groups = np.split(baskets, np.flatnonzero(np.diff(baskets) != 1) + 1)
+    range_starts = np.array([max(entry_offsets[g[0]], entry_start) for g in groups])
+    range_stops  = np.array([min(entry_offsets[g[-1] + 1], entry_stop) for g in groups])
 
-    # Load event-level cross section and weight
-    xsec_ak   = tree['Event.CrossSection'].array(library='ak')
-    weight_ak = tree['Event.Weight'].array(library='ak')
+    parts = [tree.arrays(expressions, entry_start=start, entry_stop=stop, library='ak')
+             for start, stop in zip(range_starts, range_stops)]
+    jets = parts[0] if len(parts) == 1 else ak.concatenate(parts)
+
+    # Position of every requested entry in the concatenated ranges
+    range_index = np.searchsorted(range_starts, entries, side='right') - 1
+    range_base  = np.concatenate([[0], np.cumsum(range_stops - range_starts)[:-1]])
+    rows = entries - range_starts[range_index] + range_base[range_index]
+    return jets, rows, list(zip(range_starts, range_stops))
+
+
+def basket_usage(tree, expressions, ranges):
+    """
+    Baskets and uncompressed bytes of the given branches that reading the
+    (start, stop) entry ranges decompresses, next to the totals of the
+    branches: (baskets read, baskets, bytes read, bytes).
+    """
+    starts = np.array([start for start, _ in ranges], dtype=np.int64)
+    stops = np.array([stop for _, stop in ranges], dtype=np.int64)
+    n_read = n_total = bytes_read = bytes_total = 0
+    for expression in expressions:
+        branch = tree[expression]
+        for i in range(branch.num_baskets):
+            basket_start, basket_stop = branch.basket_entry_start_stop(i)
+            size = branch.basket_uncompressed_bytes(i)
+            # A basket spanning two chunks is decompressed once per chunk
+            touched = int(np.count_nonzero((starts < basket_stop) & (stops > basket_start)))
+            n_read += touched
+            bytes_read += touched * size
+            n_total += 1
+            bytes_total += size
+    return n_read, n_total, bytes_read, bytes_total
+
+
+def parse_variation(value):
+    """Interpret a --variation argument of the form NAME:KEY=VALUE[,KEY=VALUE]."""
+    name, sep, spec = value.partition(':')
+    if not sep or not name.strip() or name.strip() == 'nominal':
+        raise argparse.ArgumentTypeError(f"expected NAME:KEY=VALUE[,KEY=VALUE], got '{value}'")
+    shifts = {}
+    for item in spec.split(','):
+        key, sep, number = item.partition('=')
+        key = key.strip()
+        if not sep or key not in VARIATION_SHIFTS:
+            raise argparse.ArgumentTypeError(
+                f"unknown shift '{item}' in '{value}', expected one of {sorted(VARIATION_SHIFTS)}")
+        try:
+            shifts[key] = float(number)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"shift '{item}' in '{value}' is not a number")
+    return name.strip(), shifts
+
+
+def parse_retag(value):
+    """Interpret a --retag argument of the form NAME:PARAMETRISATION[,FLAVOUR=SCALE]."""
+    name, sep, spec = value.partition(':')
+    parametrisation, *scales = spec.split(',')
+    if not sep or not name.strip() or parametrisation.strip() not in TAGGER_PARAMETRISATIONS:
+        raise argparse.ArgumentTypeError(
+            f"expected NAME:PARAMETRISATION[,c=SCALE][,b=SCALE][,light=SCALE] with PARAMETRISATION "
+            f"in {sorted(TAGGER_PARAMETRISATIONS)}, got '{value}'")
+    working_point = {'parametrisation': parametrisation.strip(), 'light': 1.0, 'c': 1.0, 'b': 1.0}
+    for item in scales:
+        flavour, sep, number = item.partition('=')
+        flavour = flavour.strip()
+        if not sep or flavour not in ('light', 'c', 'b'):
+            raise argparse.ArgumentTypeError(f"unknown scale '{item}' in '{value}', expected light, c or b")
+        try:
+            working_point[flavour] = float(number)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"scale '{item}' in '{value}' is not a number")
+    return name.strip(), working_point
+
+
+def tag_efficiency(pt, flavor, working_point):
+    """Per-jet tag probability for a working point, from the true jet flavour and pT."""
+    eff_light, eff_c, eff_b = TAGGER_PARAMETRISATIONS[working_point['parametrisation']]
+    abs_flavor = np.abs(flavor)
+    eff = np.where(abs_flavor == 5, working_point['b'] * eff_b(pt),
+                   np.where(abs_flavor == 4, working_point['c'] * eff_c(pt),
+                            working_point['light'] * eff_light(pt)))
+    return np.clip(eff, 0.0, 1.0)
+
+
+def row_jets(jets, rows, entries):
+    """
+    Flat pT and flavour of every jet in the given rows of the jet arrays,
+    together with the offsets of each row in them and a unique id per jet
+    (tree entry and position in the event) for the counter-based draws.
+    """
+    pt_content, pt_starts, pt_stops = jagged_buffers(jets['Jet.PT'])
+    flavor_content, flavor_starts, _ = jagged_buffers(jets['Jet.Flavor'])
+    counts = pt_stops[rows] - pt_starts[rows]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    slot = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    pt = pt_content[np.repeat(pt_starts[rows], counts) + slot]
+    flavor = flavor_content[np.repeat(flavor_starts[rows], counts) + slot]
+    jet_ids = (np.repeat(entries, counts).astype(np.uint64) << np.uint64(16)) + slot.astype(np.uint64)
+    return pt, flavor, offsets, jet_ids
+
+
+def retag_variables(row_jets_info, leading_flavor, working_points, seed, pt_scale=1.0):
+    """
+    Re-emulate the tagger for every working point with one Bernoulli draw per
+    jet. Returns nCjets_NAME and ctag_NAME (at least one tagged jet and a
+    charm leading jet) per row.
+    """
+    pt, flavor, offsets, jet_ids = row_jets_info
+    variables = {}
+    for name, working_point in working_points.items():
+        draws = counter_uniforms(seed, zlib.crc32(f'retag:{name}'.encode()), jet_ids)
+        tagged = draws < tag_efficiency(pt * pt_scale, flavor, working_point)
+        n_tagged = np.concatenate([[0], np.cumsum(tagged)])
+        n_cjets = n_tagged[offsets[1:]] - n_tagged[offsets[:-1]]
+        variables[f'nCjets_{name}'] = n_cjets
+        variables[f'ctag_{name}'] = (n_cjets > 0) & (np.abs(leading_flavor) == 4)
+    return variables
+
+
+def variation_tree_names(variation):
+    """Output trees (tagged, untagged) of a variation; the nominal keeps the plain names."""
+    if variation == 'nominal':
+        return 'c_tagged', 'untagged'
+    return f'c_tagged_{variation}', f'untagged_{variation}'
+
+
+def splitmix64(x):
+    """SplitMix64 finaliser: a fast, well-mixed hash of uint64 values (wrapping arithmetic)."""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def counter_uniforms(seed, stream, counters):
+    """
+    Uniform numbers in [0, 1) that depend only on (seed, stream, counter), so
+    that per-event (or per-jet) draws do not depend on how the input is split
+    into chunks or workers.
+    """
+    key = splitmix64(np.uint64(seed) ^ splitmix64(np.uint64(stream)))
+    bits = splitmix64(np.asarray(counters, dtype=np.uint64) ^ key)
+    return (bits >> np.uint64(11)) * (1.0 / (1 << 53))
+
+
+def counter_normals(seed, stream, counters):
+    """Standard normal numbers per counter (Box-Muller on two counter_uniforms draws)."""
+    counters = np.asarray(counters, dtype=np.uint64)
+    u1 = counter_uniforms(seed, stream, counters * np.uint64(2))
+    u2 = counter_uniforms(seed, stream, counters * np.uint64(2) + np.uint64(1))
+    return np.sqrt(-2.0 * np.log1p(-u1)) * np.cos(2.0 * math.pi * u2)
+
+
+def vary_event_variables(event_vars, shifts, entries, seed, stream):
+    """
+    Event-level variables with the shifts of a variation applied. HT is the
+    scalar sum of the jet pT, so it is scaled by jet_pt_scale, and met_sig is
+    recomputed from the varied MET and HT. The jet scale is not propagated to
+    the MET itself; use met_scale in the same variation for that.
+    """
+    jet_pt_scale = shifts.get('jet_pt_scale', 1.0)
+    met_scale = shifts.get('met_scale', 1.0)
+    met_smear = shifts.get('met_smear', 0.0)
+    if jet_pt_scale == 1.0 and met_scale == 1.0 and met_smear == 0.0:
+        return event_vars
+    met = event_vars['met_pt'] * met_scale
+    if met_smear:
+        met = np.maximum(met * (1.0 + met_smear * counter_normals(seed, stream, entries)), 0.0)
+    ht = event_vars['ht'] * jet_pt_scale
+    varied = dict(event_vars)
+    varied['met_pt'] = met
+    varied['ht'] = ht
+    with np.errstate(divide='ignore', invalid='ignore'):
+        varied['met_sig'] = np.where(ht > 0, met / np.sqrt(ht), 0.0)
+    return varied
 
-    # Load the tagging information from the correct branch
-    try:
-        tag_ak = tree['Jet.BTag'].array(library='ak')
-    except uproot.KeyInFileError:
-        print("  -> Warning: Jet.BTag branch not found. Assuming no tags.")
-        tag_ak = ak.zeros_like(jets_pt, dtype=int)
-
-    # Count all jets and c-jets per event
-    n_jets  = ak.num(jets_pt, axis=1)
-    n_cjets = ak.sum(tag_ak > 0, axis=1)
-
-    # Get leading and subleading jets and mask for events with at least two jets
-    pt1, pt2, eta1, eta2, phi1, phi2, mask2j, flavor1 = compute_leading_jets(
-        jets_pt, jets_eta, jets_phi, jets_flavor
-    )
 
-    # Apply jet kinematics selection
-    mask_jetkin = (
-        (pt1 >= 150.0) & (np.abs(eta1) <= 2.4) &
-        (pt2 >= 30.0)  & (np.abs(eta2) <= 2.8)
+def vary_jet_variables(jet_vars, shifts):
+    """Jet variables with the jet pT scale of a variation applied (the jet order is unchanged)."""
+    scale = shifts.get('jet_pt_scale', 1.0)
+    varied = dict(jet_vars)
+    if scale == 1.0:
+        return varied
+    varied['jet1_pt'] = jet_vars['jet1_pt'] * scale
+    varied['jet2_pt'] = jet_vars['jet2_pt'] * scale
+    return varied
+
+
+def parse_compression(value):
+    """Check a --compression argument ("none" or "codec:level") and return it normalised."""
+    value = value.strip().lower()
+    if value == 'none':
+        return value
+    codec, _, level = value.partition(':')
+    if codec not in COMPRESSION_CODECS or not level.isdigit():
+        raise argparse.ArgumentTypeError(
+            f"expected 'none' or CODEC:LEVEL with CODEC in {sorted(COMPRESSION_CODECS)}, got '{value}'")
+    return f"{codec}:{int(level)}"
+
+
+def compression_from_spec(spec):
+    """The uproot compression object for a "codec:level" string (None for "none")."""
+    if spec == 'none':
+        return None
+    codec, _, level = spec.partition(':')
+    return COMPRESSION_CODECS[codec](int(level))
+
+
+class BasketWriter:
+    """
+    Appends selected events to an output TTree in baskets of basket_entries
+    events (each extend call writes one basket per branch). With
+    basket_entries=None every non-empty chunk becomes one basket.
+    """
+
+    def __init__(self, tree, basket_entries=None):
+        self.tree = tree
+        self.basket_entries = basket_entries
+        self.pending = []
+        self.n_pending = 0
+
+    def append(self, branches):
+        n = len(next(iter(branches.values())))
+        if n == 0:
+            return
+        if self.basket_entries is None:
+            self.tree.extend(branches)
+            return
+        self.pending.append(branches)
+        self.n_pending += n
+        if self.n_pending >= self.basket_entries:
+            self._write(final=False)
+
+    def flush(self):
+        if self.n_pending:
+            self._write(final=True)
+
+    def _write(self, final):
+        merged = {name: np.concatenate([part[name] for part in self.pending]) for name in self.pending[0]}
+        start = 0
+        while self.n_pending - start >= self.basket_entries or (final and start < self.n_pending):
+            stop = min(start + self.basket_entries, self.n_pending)
+            self.tree.extend({name: values[start:stop] for name, values in merged.items()})
+            start = stop
+        self.pending = [{name: values[start:] for name, values in merged.items()}] if start < self.n_pending else []
+        self.n_pending -= start
+
+
+def write_trees(output_name, trees, compression=DEFAULT_COMPRESSION, basket_entries=None):
+    """Write {tree name: branches} to a new ROOT file with the given settings."""
+    with uproot.recreate(output_name, compression=compression_from_spec(compression)) as out:
+        for tree_name, branches in trees.items():
+            out.mktree(tree_name, {name: values.dtype for name, values in branches.items()})
+            writer = BasketWriter(out[tree_name], basket_entries)
+            writer.append(branches)
+            writer.flush()
+
+
+def benchmark_compression(flat_tuple, output_dir=None, repeat=3):
+    """
+    Rewrite the trees of an existing flat tuple with every combination of
+    BENCHMARK_COMPRESSIONS and BENCHMARK_BASKET_ENTRIES and report the write
+    time, file size and the time to read all branches back.
+    """
+    with uproot.open(flat_tuple) as f:
+        trees = {name: f[name].arrays(library='np') for name in ['c_tagged', 'untagged'] if name in f}
+    n_events = sum(len(next(iter(branches.values()), [])) for branches in trees.values())
+    print(f"Benchmarking output settings on {flat_tuple} ({n_events} events), best of {repeat}")
+    print(f"  {'Compression':<12} {'Basket':>8} {'Write [ms]':>11} {'Size [kB]':>10} {'Read [ms]':>10}")
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmpdir:
+        for compression in BENCHMARK_COMPRESSIONS:
+            for basket_entries in BENCHMARK_BASKET_ENTRIES:
+                path = os.path.join(tmpdir, f"bench_{compression.replace(':', '')}_{basket_entries}.root")
+                write_time = read_time = float('inf')
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    write_trees(path, trees, compression, basket_entries)
+                    write_time = min(write_time, time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    with uproot.open(path) as f:
+                        for name in trees:
+                            f[name].arrays(library='np')
+                    read_time = min(read_time, time.perf_counter() - start)
+                basket = 'all' if basket_entries is None else str(basket_entries)
+                print(f"  {compression:<12} {basket:>8} {write_time * 1e3:>11.1f} "
+                      f"{os.path.getsize(path) / 1024:>10.1f} {read_time * 1e3:>10.1f}")
+                os.remove(path)
+
+
+def parse_cut(value):
+    """Interpret a --cut argument of the form NAME=EXPRESSION."""
+    name, sep, expression = value.partition('=')
+    if not sep or not name.strip() or not expression.strip():
+        raise argparse.ArgumentTypeError(f"expected NAME=EXPRESSION, got '{value}'")
+    return [name.strip(), expression.strip()]
+
+
+def compile_cuts(cuts):
+    """
+    Compile [name, expression] cuts and split them into event-level cuts (only
+    using EVENT_VARIABLES) and jet-level cuts, each keeping the given order.
+    Jet-level cuts may also use event variables, e.g. 'met_pt > 0.5*jet1_pt'.
+    """
+    known = set(EVENT_VARIABLES) | set(JET_VARIABLES) | set(CUT_FUNCTIONS)
+    event_cuts, jet_cuts = [], []
+    for name, expression in cuts:
+        code = compile(expression, f"<cut {name}>", 'eval')
+        unknown = set(code.co_names) - known
+        if unknown:
+            raise ValueError(f"Cut '{name}' uses unknown variable(s): {', '.join(sorted(unknown))}")
+        if set(code.co_names) <= set(EVENT_VARIABLES) | set(CUT_FUNCTIONS):
+            event_cuts.append((name, expression, code))
+        else:
+            jet_cuts.append((name, expression, code))
+    return event_cuts, jet_cuts
+
+
+def apply_cuts(cuts, variables, n_events, cutflow, mask=None):
+    """
+    Fuse the cuts into a single mask over n_events events, adding the number
+    of events that pass each cut (and all cuts before it) to cutflow. An
+    initial mask restricts the events the cuts start from.
+    """
+    mask = np.ones(n_events, dtype=bool) if mask is None else mask.copy()
+    namespace = {'__builtins__': {}, **CUT_FUNCTIONS}
+    for name, _, code in cuts:
+        mask &= eval(code, namespace, variables)
+        cutflow[name] += int(np.count_nonzero(mask))
+    return mask
+
+
+def print_cutflow(cutflow, cuts, title='nominal'):
+    """Print the number of events passing each cut, in evaluation order."""
+    n_all = cutflow['all']
+    lines = [f"  Cutflow ({title})",
+             f"  {'Cut':<12} {'Expression':<28} {'Events':>10} {'Eff.':>8}",
+             f"  {'all':<12} {'':<28} {n_all:>10} {100.0:>7.1f}%"]
+    for name, expression, _ in cuts:
+        eff = 100.0 * cutflow[name] / n_all if n_all else 0.0
+        lines.append(f"  {name:<12} {expression:<28} {cutflow[name]:>10} {eff:>7.1f}%")
+    # One print call, so tables of parallel workers do not interleave
+    print("\n".join(lines))
+
+
+def event_variables(events):
+    """Event-level variables of a chunk, as flat NumPy arrays."""
+    # MET, HT and the event info hold exactly one entry per event
+    met = events['MissingET.MET'][:, 0].to_numpy()
+    ht  = events['ScalarHT.HT'][:, 0].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        met_significance = np.where(ht > 0, met / np.sqrt(ht), 0.0)
+    return {
+        'nJets': events[JET_COUNTER].to_numpy(),
+        'met_pt': met,
+        'met_phi': events['MissingET.Phi'][:, 0].to_numpy(),
+        'met_sig': met_significance,
+        'ht': ht,
+        'event_xsec': events['Event.CrossSection'][:, 0].to_numpy(),
+        'event_weight': events['Event.Weight'][:, 0].to_numpy(),
+    }
+
+
+def jet_variables(jets, rows, met_phi, has_tag):
+    """
+    Leading/subleading jet variables and the number of tagged jets for the
+    given rows of the jet arrays. All rows must have at least two jets.
+    met_phi holds the MET direction of the same events.
+    """
+    pt1, pt2, eta1, eta2, phi1, phi2, _, flavor1 = compute_leading_jets(
+        jets['Jet.PT'], jets['Jet.Eta'], jets['Jet.Phi'], jets['Jet.Flavor'], rows
     )
 
-    # Convert MET to NumPy and apply the two-jet mask
-    met     = met_ak[mask2j].to_numpy().squeeze()
-    met_phi = met_phi_ak[mask2j].to_numpy().squeeze()
-
-    # Keep only events that pass the jet kinematics
-    pt1     = pt1[mask_jetkin].astype(np.float32)
-    pt2     = pt2[mask_jetkin].astype(np.float32)
-    eta1    = eta1[mask_jetkin].astype(np.float32)
-    eta2    = eta2[mask_jetkin].astype(np.float32)
-    phi1    = phi1[mask_jetkin].astype(np.float32)
-    phi2    = phi2[mask_jetkin].astype(np.float32)
-    met     = met[mask_jetkin].astype(np.float32)
-    met_phi = met_phi[mask_jetkin].astype(np.float32)
-    flavor1 = flavor1[mask_jetkin]
-
-    # Now apply the MET selection
-    mask_met = met >= 200.0
-    pt1      = pt1[mask_met]
-    pt2      = pt2[mask_met]
-    eta1     = eta1[mask_met]
-    eta2     = eta2[mask_met]
-    phi1     = phi1[mask_met]
-    phi2     = phi2[mask_met]
-    met      = met[mask_met]
-    met_phi  = met_phi[mask_met]
-    flavor1  = flavor1[mask_met]
-
-    # Build an index array to slice other branches in the same order
-    idx_all = np.where(mask2j)[0]
-    idx_all = idx_all[mask_jetkin]
-    idx_all = idx_all[mask_met]
-
-    # Slice other event-level variables
-    n_jets  = n_jets.to_numpy()[idx_all].astype(np.int32)
-    n_cjets = n_cjets.to_numpy()[idx_all].astype(np.int32)
-    cross   = xsec_ak.to_numpy().squeeze()[idx_all].astype(np.float32)
-    weight  = weight_ak.to_numpy().squeeze()[idx_all].astype(np.float32)
-    ht      = ht_ak.to_numpy().squeeze()[idx_all].astype(np.float32)
-
-    # Compute additional derived quantities
-    jet1_met_dphi    = compute_dphi(phi1, met_phi).astype(np.float32)
-    met_significance = np.where(ht > 0, met / np.sqrt(ht), 0.0).astype(np.float32)
-
-    # Gather all variables into a dictionary for output
-    branches = {
+    # Count tagged jets per event from a running sum over the flat tag buffer
+    if has_tag:
+        tag_content, tag_starts, tag_stops = jagged_buffers(jets[TAG_BRANCH])
+        n_tagged = np.concatenate([[0], np.cumsum(tag_content > 0)])
+        n_cjets = n_tagged[tag_stops[rows]] - n_tagged[tag_starts[rows]]
+    else:
+        n_cjets = np.zeros(len(rows), dtype=np.int32)
+
+    return {
         'jet1_pt': pt1,
         'jet2_pt': pt2,
         'jet1_eta': eta1,
         'jet2_eta': eta2,
         'jet1_phi': phi1,
         'jet2_phi': phi2,
-        'met_pt': met,
-        'jet1met_dphi': jet1_met_dphi,
-        'met_sig': met_significance,
-        'nJets': n_jets,
+        'jet1_flavor': flavor1,
+        'jet1met_dphi': compute_dphi(phi1, met_phi),
         'nCjets': n_cjets,
-        'event_xsec': cross,
-        'event_weight': weight
     }
 
-    # Split events into tagged and untagged samples
-    # An event is c-tagged if it has at least one tagged jet AND the leading jet is a charm jet.
-    has_tagged_jet = branches['nCjets'] > 0
-    is_leading_charm = np.abs(flavor1) == 4
-    tag_mask   = has_tagged_jet & is_leading_charm
 
-    untag_mask = ~tag_mask
-    tagged     = {k: v[tag_mask]   for k, v in branches.items()}
-    untagged   = {k: v[untag_mask] for k, v in branches.items()}
+def flatten_tree(input_path, output_name, step_size=None, cuts=SELECTION_CUTS,
+                 compression=DEFAULT_COMPRESSION, basket_entries=None,
+                 variations=None, seed=DEFAULT_SEED, retag=None):
+    """
+    Select events from the Delphes tree of input_path and write them to the
+    c_tagged/untagged trees of output_name, reading step_size events (or a
+    memory size such as "200 MB") at a time, or all at once if None.
+    variations maps names to VARIATION_SHIFTS; each one is selected from the
+    same read and written to its own pair of trees. retag maps working point
+    names to re-tagging settings (see parse_retag), each adding its own
+    nCjets_NAME/ctag_NAME branches.
+    Returns the number of tagged and untagged nominal events written.
+    """
+    retag = retag or {}
+    output_types = dict(OUTPUT_TYPES)
+    for name in retag:
+        output_types[f'nCjets_{name}'] = 'int32'
+        output_types[f'ctag_{name}'] = 'int32'
+    event_cuts, jet_cuts = compile_cuts(cuts)
+    # Event variables that jet-level cuts use alongside the jet variables
+    jet_cut_event_names = sorted({n for _, _, code in jet_cuts for n in code.co_names}
+                                 & (set(EVENT_VARIABLES) - set(JET_VARIABLES)))
+    variations = {'nominal': {}, **(variations or {})}
+    streams = {name: zlib.crc32(name.encode()) for name in variations}
+    cutflows = {name: dict.fromkeys(['all'] + [cut[0] for cut in cuts], 0) for name in variations}
+    n_written = {name: [0, 0] for name in variations}
+
+    # Open the ROOT file, access the Delphes tree and book the output TTrees
+    with uproot.open(input_path) as root_file, \
+            uproot.recreate(output_name, compression=compression_from_spec(compression)) as out:
+        tree = root_file['Delphes']
+
+        # Load the tagging information from the correct branch
+        has_tag = TAG_BRANCH in tree
+        if not has_tag:
+            print("  -> Warning: Jet.BTag branch not found. Assuming no tags.")
+        jet_expressions = JET_BRANCHES + ([TAG_BRANCH] if has_tag else [])
+        jet_entry_offsets = tree[JET_BRANCHES[0]].entry_offsets
+
+        writers = {}
+        for variation in variations:
+            for tree_name in variation_tree_names(variation):
+                out.mktree(tree_name, output_types)
+                writers[tree_name] = BasketWriter(out[tree_name], basket_entries)
+
+        if step_size is None:
+            step_size = max(tree.num_entries, 1)
+        elif isinstance(step_size, str):
+            # A memory size must also cover the jet collections read for each chunk, not only the small
+            # event branches that are iterated, or "200 MB" would span millions of events
+            step_size = max(tree.num_entries_for(step_size, EVENT_BRANCHES + [JET_COUNTER] + jet_expressions), 1)
+
+        # Only the cheap event-level branches are streamed; the jet collections
+        # are read afterwards for the events that pass the event-level cuts of
+        # at least one variation.
+        n_presel = n_jet_entries = 0
+        jet_ranges = []
+        for events, report in tree.iterate(EVENT_BRANCHES + [JET_COUNTER], step_size=step_size,
+                                           library='ak', report=True):
+            entries = np.arange(report.tree_entry_start, report.tree_entry_stop)
+            nominal_vars = event_variables(events)
+            event_vars = {}
+            event_masks = {}
+            for variation, shifts in variations.items():
+                event_vars[variation] = vary_event_variables(nominal_vars, shifts, entries,
+                                                             seed, streams[variation])
+                cutflows[variation]['all'] += len(events)
+                event_masks[variation] = apply_cuts(event_cuts, event_vars[variation], len(events),
+                                                    cutflows[variation])
 
-    # Decide branch types based on array dtypes
-    types = {name: ('float32' if arr.dtype.kind == 'f' else 'int32')
-             for name, arr in branches.items()}
+            # The leading-jet variables need at least two jets
+            presel = np.flatnonzero(np.logical_or.reduce(list(event_masks.values()))
+                                    & (nominal_vars['nJets'] >= 2))
+            if len(presel) == 0:
+                continue
 
-    # Write the output file with two TTrees
-    with uproot.recreate(output_name) as out:
-        out.mktree('c_tagged', types)
-        out['c_tagged'].extend(tagged)
-        out.mktree('untagged', types)
-        out['untagged'].extend(untagged)
+            jets, rows, ranges = read_jets(tree, jet_expressions, entries[presel], jet_entry_offsets,
+                                           report.tree_entry_start, report.tree_entry_stop)
+            jet_ranges.extend(ranges)
+            n_presel += len(presel)
+            n_jet_entries += len(jets)
+            nominal_jet_vars = jet_variables(jets, rows, nominal_vars['met_phi'][presel], has_tag)
+            if retag:
+                retag_jets = row_jets(jets, rows, entries[presel])
 
-    print('Wrote', len(tagged['jet1_pt']), 'tagged and',
-          len(untagged['jet1_pt']), 'untagged events to', output_name)
+            for variation, shifts in variations.items():
+                jet_vars = vary_jet_variables(nominal_jet_vars, shifts)
+                if retag:
+                    jet_vars.update(retag_variables(retag_jets, jet_vars['jet1_flavor'], retag, seed,
+                                                    shifts.get('jet_pt_scale', 1.0)))
+                cut_vars = {**{n: event_vars[variation][n][presel] for n in jet_cut_event_names}, **jet_vars}
+                selected = np.flatnonzero(apply_cuts(jet_cuts, cut_vars, len(presel), cutflows[variation],
+                                                     event_masks[variation][presel]))
+
+                # An event is c-tagged if it has at least one tagged jet AND the leading jet is a charm jet.
+                tag_mask = (jet_vars['nCjets'][selected] > 0) & (np.abs(jet_vars['jet1_flavor'][selected]) == 4)
+
+                # One gather per output branch and category, straight from the chunk arrays
+                tree_names = variation_tree_names(variation)
+                for tree_name, rows_out in zip(tree_names, [selected[tag_mask], selected[~tag_mask]]):
+                    branches = {}
+                    for name, dtype in output_types.items():
+                        if name in jet_vars:
+                            branches[name] = jet_vars[name][rows_out].astype(dtype)
+                        else:
+                            branches[name] = event_vars[variation][name][presel[rows_out]].astype(dtype)
+                    writers[tree_name].append(branches)
+
+                n_written[variation][0] += int(np.count_nonzero(tag_mask))
+                n_written[variation][1] += int(np.count_nonzero(~tag_mask))
+
+        for writer in writers.values():
+            writer.flush()
+
+        n_read, n_baskets, bytes_read, bytes_total = basket_usage(tree, jet_expressions, jet_ranges)
+        print(f"  -> Event-level cuts kept {n_presel} of {tree.num_entries} events; "
+              f"jet branches read for {n_jet_entries} entries, decompressing {n_read} of {n_baskets} "
+              f"baskets ({bytes_read / 1e6:.1f} of {bytes_total / 1e6:.1f} MB)")
+
+    for variation in variations:
+        print_cutflow(cutflows[variation], event_cuts + jet_cuts, variation)
+        if variation != 'nominal':
+            print(f"  -> {variation}: {n_written[variation][0]} tagged and "
+                  f"{n_written[variation][1]} untagged events")
+    return tuple(n_written['nominal'])
+
+
+def output_path_for(input_path, output_dir='.'):
+    """Output file for a Delphes input: the 'delphes' prefix becomes 'flat_tuple'."""
+    filename = os.path.basename(input_path)
+    return os.path.join(output_dir, filename.replace('delphes', 'flat_tuple', 1))
+
+
+def file_sha256(path, block_size=1 << 20):
+    """SHA-256 of a file's content, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_signature(input_path, use_hash=False):
+    """Size and mtime of an input file, plus its content hash if use_hash."""
+    stat = os.stat(input_path)
+    signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if use_hash:
+        signature['sha256'] = file_sha256(input_path)
+    return signature
+
+
+def load_manifest(output_dir):
+    """Read the manifest of output_dir, or return an empty one."""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir, manifest):
+    """Atomically write the manifest of output_dir."""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.part', path)
+
+
+def manifest_settings(settings):
+    """The part of the settings that determines the output content."""
+    return {k: v for k, v in settings.items() if k not in RUNTIME_SETTINGS}
+
+
+def is_up_to_date(entry, input_path, output_path, settings, use_hash):
+    """
+    Whether a manifest entry shows that output_path was built from the current
+    input_path with the current settings and flattener version.
+    """
+    if entry is None or not os.path.exists(output_path):
+        return False
+    if entry.get('version') != FLATTENER_VERSION or entry.get('settings') != manifest_settings(settings):
+        return False
+    recorded = entry.get('input', {})
+    current = input_signature(input_path)
+    if recorded.get('size') == current['size'] and recorded.get('mtime_ns') == current['mtime_ns']:
+        return True
+    # Touched but possibly unchanged: compare the content hash if we have one
+    return use_hash and 'sha256' in recorded and recorded['sha256'] == file_sha256(input_path)
+
+
+def process_file(input_path, output_dir='.', step_size=None, cuts=SELECTION_CUTS,
+                 compression=DEFAULT_COMPRESSION, basket_entries=None,
+                 variations=None, seed=DEFAULT_SEED, retag=None):
+    """
+    Flatten one Delphes file into flat_tuple_*.root in output_dir.
+    Returns the number of tagged and untagged events written.
+    """
+    # Prepare the output filename
+    filename = os.path.basename(input_path)
+    output_name = output_path_for(input_path, output_dir)
+    print(f"Reading {filename} and writing {output_name}")
+
+    # Write to a temporary name first so a failed file leaves no partial output
+    partial_name = output_name + '.part'
+    try:
+        n_tagged, n_untagged = flatten_tree(input_path, partial_name, step_size, cuts,
+                                            compression, basket_entries, variations, seed, retag)
+    except BaseException:
+        if os.path.exists(partial_name):
+            os.remove(partial_name)
+        raise
+    os.replace(partial_name, output_name)
+
+    print('Wrote', n_tagged, 'tagged and', n_untagged,
+          'untagged events to', output_name)
+    return n_tagged, n_untagged
+
+
+def run_sequential(input_files, settings, on_result=None):
+    """
+    Flatten the inputs one after the other, returning {file: result or error}.
+    on_result(file, result or error) is called as soon as each file is done.
+    """
+    results = {}
+    for rootfile in input_files:
+        try:
+            results[rootfile] = process_file(rootfile, **settings)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"  -> ERROR: {rootfile} failed: {e!r}")
+            results[rootfile] = e
+        if on_result:
+            on_result(rootfile, results[rootfile])
+    return results
+
+
+def run_parallel(input_files, settings, n_jobs, on_result=None):
+    """Flatten the inputs in a pool of n_jobs processes, one file per task (on_result as in run_sequential)."""
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(process_file, rootfile, **settings): rootfile
+                   for rootfile in input_files}
+        for future in as_completed(futures):
+            rootfile = futures[future]
+            try:
+                results[rootfile] = future.result()
+            except Exception as e:
+                print(f"  -> ERROR: {rootfile} failed: {e!r}")
+                results[rootfile] = e
+            if on_result:
+                on_result(rootfile, results[rootfile])
+    return results
+
+
+def print_summary(results, skipped=()):
+    """Print the per-file and combined tagged/untagged counts."""
+    print("-" * 83)
+    print(f"{'Input file':<40} | {'Tagged':>10} | {'Untagged':>10} | {'Status':>10}")
+    print("-" * 83)
+    total_tagged = total_untagged = 0
+    failed = []
+    for rootfile in sorted(results):
+        result = results[rootfile]
+        if isinstance(result, Exception):
+            failed.append(rootfile)
+            print(f"{rootfile:<40} | {'':>10} | {'':>10} | {'FAILED':>10}")
+            continue
+        n_tagged, n_untagged = result
+        total_tagged += n_tagged
+        total_untagged += n_untagged
+        status = 'up to date' if rootfile in skipped else 'written'
+        print(f"{rootfile:<40} | {n_tagged:>10} | {n_untagged:>10} | {status:>10}")
+    print("-" * 83)
+    print(f"{'Total':<40} | {total_tagged:>10} | {total_untagged:>10} |")
+    if failed:
+        print(f"{len(failed)} of {len(results)} file(s) failed: {', '.join(failed)}")
+    return failed
 
 
 def main():
-    for rootfile in glob.glob('delphes_*.root'):
-        process_file(rootfile)
+    parser = argparse.ArgumentParser(description="Flatten Delphes files into c_tagged/untagged ntuples.")
+    parser.add_argument("--step-size", type=parse_step_size, default=None,
+                        help="Stream the input in chunks of this many events, or of this memory size "
+                             "(e.g. '200 MB'). Default: read each file in one go.")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of worker processes, one input file per task (default: 1).")
+    parser.add_argument("--cut", type=parse_cut, action="append", default=[], metavar="NAME=EXPRESSION",
+                        help="Replace the cut called NAME (or append a new one), e.g. "
+                             "--cut 'met=met_pt >= 250'. Can be given several times.")
+    parser.add_argument("--cuts-file",
+                        help="JSON file with the full ordered list of [name, expression] cuts "
+                             "to use instead of SELECTION_CUTS.")
+    parser.add_argument("--output-dir", default=".",
+                        help="Directory for the flat tuples and their manifest (default: current directory).")
+    parser.add_argument("--hash", action="store_true",
+                        help="Also record a SHA-256 of every input, so inputs that were only touched "
+                             "are not rebuilt.")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild all outputs, even those the manifest marks as up to date.")
+    parser.add_argument("--variation", type=parse_variation, action="append", default=[],
+                        metavar="NAME:KEY=VALUE[,KEY=VALUE]",
+                        help="Also write c_tagged_NAME/untagged_NAME trees with the given shifts "
+                             f"({', '.join(VARIATION_SHIFTS)}). jet_pt_scale also scales HT (and so "
+                             "met_sig) but not the MET. Can be given several times.")
+    parser.add_argument("--variations-file",
+                        help="JSON file mapping variation names to {shift: value} dictionaries.")
+    parser.add_argument("--retag", type=parse_retag, action="append", default=[],
+                        metavar="NAME:PARAMETRISATION[,c=SCALE][,b=SCALE][,light=SCALE]",
+                        help="Re-tag jets from their true flavour and pT with the given efficiency "
+                             f"parametrisation ({', '.join(TAGGER_PARAMETRISATIONS)}), writing "
+                             "nCjets_NAME and ctag_NAME branches. Can be given several times.")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help=f"Seed for the MET smearing and the re-tagging draws (default: {DEFAULT_SEED}).")
+    parser.add_argument("--compression", type=parse_compression, default=DEFAULT_COMPRESSION,
+                        help="Output codec as CODEC:LEVEL with CODEC one of zlib, lz4, zstd, lzma, "
+                             f"or 'none' (default: {DEFAULT_COMPRESSION}).")
+    parser.add_argument("--basket-entries", type=int, default=None,
+                        help="Events per output basket. Default: one basket per input chunk.")
+    parser.add_argument("--benchmark-compression", metavar="FLAT_TUPLE",
+                        help="Rewrite FLAT_TUPLE with a range of codecs and basket sizes, report write time, "
+                             "file size and read time for each, and exit.")
+    parser.add_argument("--benchmark-leading-jets", type=int, metavar="N_EVENTS", nargs="?", const=1_000_000,
+                        help="Compare the top-2 jet kernel with the argsort path on N_EVENTS random "
+                             "events (default: 1M) and exit.")
+    args = parser.parse_args()
+
+    if args.benchmark_leading_jets:
+        benchmark_leading_jets(args.benchmark_leading_jets)
+        return
+    if args.benchmark_compression:
+        benchmark_compression(args.benchmark_compression, args.output_dir)
+        return
+
+    input_files = sorted(glob.glob('delphes_*.root'))
+    if not input_files:
+        print("No delphes_*.root files found in the current directory.")
+        return
+
+    if args.cuts_file:
+        with open(args.cuts_file) as f:
+            cuts = [list(cut) for cut in json.load(f)]
+    else:
+        cuts = [list(cut) for cut in SELECTION_CUTS]
+    for name, expression in args.cut:
+        for cut in cuts:
+            if cut[0] == name:
+                cut[1] = expression
+                break
+        else:
+            cuts.append([name, expression])
+    try:
+        compile_cuts(cuts)
+    except (ValueError, SyntaxError) as e:
+        parser.error(f"invalid cut: {e}")
+
+    variations = {}
+    if args.variations_file:
+        with open(args.variations_file) as f:
+            variations = json.load(f)
+    variations.update(dict(args.variation))
+    for name, shifts in variations.items():
+        unknown = set(shifts) - set(VARIATION_SHIFTS)
+        if name == 'nominal' or unknown:
+            parser.error(f"invalid variation '{name}': {shifts}")
+
+    settings = {'output_dir': args.output_dir, 'step_size': args.step_size, 'cuts': cuts,
+                'compression': args.compression, 'basket_entries': args.basket_entries,
+                'variations': variations, 'seed': args.seed, 'retag': dict(args.retag)}
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Skip the inputs whose outputs are up to date according to the manifest
+    manifest = load_manifest(args.output_dir)
+    results = {}
+    to_process = []
+    for rootfile in input_files:
+        output_name = os.path.basename(output_path_for(rootfile))
+        entry = manifest.get(output_name)
+        if not args.force and is_up_to_date(entry, rootfile, output_path_for(rootfile, args.output_dir),
+                                            settings, args.hash):
+            print(f"Skipping {rootfile}: {output_name} is up to date")
+            entry['input'].update(input_signature(rootfile))
+            results[rootfile] = (entry['n_tagged'], entry['n_untagged'])
+        else:
+            to_process.append(rootfile)
+    skipped = set(results)
+    save_manifest(args.output_dir, manifest)
+
+    def record(rootfile, result):
+        """Record what an output was built from as soon as it is written, so an interrupted run keeps it."""
+        output_name = os.path.basename(output_path_for(rootfile))
+        if isinstance(result, Exception):
+            manifest.pop(output_name, None)
+        else:
+            manifest[output_name] = {
+                'input': {'path': os.path.abspath(rootfile), **input_signature(rootfile, args.hash)},
+                'settings': manifest_settings(settings),
+                'version': FLATTENER_VERSION,
+                'n_tagged': result[0],
+                'n_untagged': result[1],
+            }
+        save_manifest(args.output_dir, manifest)
+
+    if args.jobs > 1:
+        results.update(run_parallel(to_process, settings, args.jobs, record))
+    else:
+        results.update(run_sequential(to_process, settings, record))
+
+    if print_summary(results, skipped):
+        raise SystemExit(1)
 
 if __name__ == '__main__':
     main()
@@ -1,11 +1,15 @@
 import os
+import sys
 import math
 from glob import glob
-import uproot
 import numpy as np
 import matplotlib.pyplot as plt
 from puma import Histogram, HistogramPlot
 
+# Columns are read through the shared memory-mapped cache next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import column_cache
+
 # --- Configuration ---
 
 # Define the path to your top-level directory
@@ -50,16 +54,15 @@ for region in regions:
     variables = []
     try:
         # Use the first background file to discover variables for this region
-        with uproot.open(bkg_files[0]) as f:
-            if region not in f:
-                print(f"TTree '{region}' not found in {bkg_files[0]}. Skipping this region.")
-                continue # Skip to the next region
-            tree = f[region]
-            # Discover all variables
-            discovered_variables = [key for key in tree.keys()]
-            # Filter out excluded variables
-            variables = [v for v in discovered_variables if v not in variables_to_exclude]
-            print(f"Successfully discovered and filtered variables. Plotting {len(variables)} variables in TTree '{region}'.")
+        trees = column_cache.tree_index(bkg_files[0])
+        if region not in trees:
+            print(f"TTree '{region}' not found in {bkg_files[0]}. Skipping this region.")
+            continue # Skip to the next region
+        # Discover all variables
+        discovered_variables = list(trees[region]["branches"])
+        # Filter out excluded variables
+        variables = [v for v in discovered_variables if v not in variables_to_exclude]
+        print(f"Successfully discovered and filtered variables. Plotting {len(variables)} variables in TTree '{region}'.")
     except Exception as e:
         print(f"Error reading variables for region '{region}' from {bkg_files[0]}: {e}")
         continue # Skip to the next region
@@ -98,14 +101,14 @@ for region in regions:
 
                 # --- Load all data for this variable ---
                 try:
-                    with uproot.open(sig_file) as f:
-                        if region not in f or var not in f[region]:
-                            print(f"    ! Warning: '{region}/{var}' not in {sig_file}. Skipping plot.")
-                            ax.text(0.5, 0.5, f"'{var}'\nnot found in signal", ha='center', va='center', style='italic')
-                            ax.set_yticklabels([])
-                            ax.set_xticklabels([])
-                            continue
-                        signal_values = f[region].arrays([var], library="np")[var]
+                    trees = column_cache.tree_index(sig_file)
+                    if region not in trees or var not in trees[region]["branches"]:
+                        print(f"    ! Warning: '{region}/{var}' not in {sig_file}. Skipping plot.")
+                        ax.text(0.5, 0.5, f"'{var}'\nnot found in signal", ha='center', va='center', style='italic')
+                        ax.set_yticklabels([])
+                        ax.set_xticklabels([])
+                        continue
+                    signal_values = column_cache.read_branches(sig_file, region, [var])[var]
                 except Exception as e:
                     print(f"    ! Error loading signal {var} from {sig_file}: {e}")
                     continue
@@ -114,11 +117,11 @@ for region in regions:
                 all_bkg_values_for_var = []
                 for bkg_file in bkg_files:
                     try:
-                        with uproot.open(bkg_file) as f:
-                            if region in f and var in f[region]:
-                                bkg_values = f[region].arrays([var], library="np")[var]
-                                background_data[bkg_file] = bkg_values
-                                all_bkg_values_for_var.append(bkg_values)
+                        trees = column_cache.tree_index(bkg_file)
+                        if region in trees and var in trees[region]["branches"]:
+                            bkg_values = column_cache.read_branches(bkg_file, region, [var])[var]
+                            background_data[bkg_file] = bkg_values
+                            all_bkg_values_for_var.append(bkg_values)
                     except Exception as e:
                         print(f"    ! Error loading background {var} from {bkg_file}: {e}")
 
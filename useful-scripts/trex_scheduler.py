@@ -0,0 +1,116 @@
+"""
+Parallel scheduler for the per-point TRExFitter jobs of the run_all_signals drivers.
+
+The drivers first write one config per signal point and then hand the
+trex-fitter commands to run_jobs(). run_jobs() runs up to max_workers of
+them at a time. The stdout and stderr of each job go to its own
+<log_dir>/<name>.log. A failing point does not stop the others. At the end
+a status table with the wall time of every point is printed.
+
+Running this file directly runs arbitrary commands the same way, one per
+argument, which is handy to rerun a few failed points:
+
+    python trex_scheduler.py -j 2 "trex-fitter nwdpf config_LQ_2TeV_ctagged.txt" "trex-fitter nwdpf config_DM_1p5TeV_ctagged.txt"
+"""
+import os
+import time
+import shlex
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# CPUs this process may run on, which can be fewer than the machine has (batch slots, taskset)
+DEFAULT_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+LOG_DIR = "trex-logs"
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s" if hours else f"{minutes}m {seconds:02d}s"
+
+
+def _run_job(command, log_path):
+    """Run one command with its output in log_path; returns (status, return code, wall time in seconds)."""
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        log.write(f"# {' '.join(command)}\n")
+        log.flush()
+        try:
+            returncode = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, text=True).returncode
+        except OSError as e:
+            log.write(f"ERROR: could not start {command[0]}: {e}\n")
+            return "not started", None, time.perf_counter() - start
+    return ("ok" if returncode == 0 else "FAILED"), returncode, time.perf_counter() - start
+
+
+def print_status_table(results):
+    print(f"\n{'-' * 100}")
+    print(f"{'Job':<28} | {'Status':<12} | {'Exit':>4} | {'Wall time':>11} | Log")
+    print('-' * 100)
+    for result in results:
+        exit_code = '-' if result["returncode"] is None else result["returncode"]
+        print(f"{result['name']:<28} | {result['status']:<12} | {exit_code:>4} | "
+              f"{format_duration(result['wall_time']):>11} | {result['log']}")
+    print('-' * 100)
+    n_ok = sum(result["status"] == "ok" for result in results)
+    print(f"{n_ok}/{len(results)} jobs succeeded.")
+
+
+def run_jobs(jobs, max_workers=DEFAULT_WORKERS, log_dir=LOG_DIR):
+    """
+    Run [(name, command)] jobs with at most max_workers at a time and print a
+    status table. Returns one result dict per job, in the order given, with
+    'name', 'status' ('ok', 'FAILED' or 'not started'), 'returncode',
+    'wall_time' and 'log'.
+    """
+    missing = sorted({command[0] for _, command in jobs if shutil.which(command[0]) is None})
+    if missing:
+        print(f"\nERROR: {', '.join(repr(m) for m in missing)} command not found. Is it in your PATH?")
+        return [{"name": name, "status": "not started", "returncode": None, "wall_time": 0.0, "log": "-"}
+                for name, _ in jobs]
+
+    os.makedirs(log_dir, exist_ok=True)
+    workers = max(1, min(max_workers, len(jobs)))
+    print(f"\nRunning {len(jobs)} jobs, {workers} at a time (logs in {log_dir}/)")
+    results = [None] * len(jobs)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for i, (name, command) in enumerate(jobs):
+            log_path = os.path.join(log_dir, f"{name}.log")
+            print(f"Queued {name}: {' '.join(command)} > {log_path}")
+            futures[pool.submit(_run_job, command, log_path)] = i
+        for future in as_completed(futures):
+            i = futures[future]
+            name, _ = jobs[i]
+            status, returncode, wall_time = future.result()
+            results[i] = {"name": name, "status": status, "returncode": returncode,
+                          "wall_time": wall_time, "log": os.path.join(log_dir, f"{name}.log")}
+            print(f"--- {name}: {status} after {format_duration(wall_time)} ---")
+
+    print_status_table(results)
+    print(f"Total wall time: {format_duration(time.perf_counter() - start)}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run commands in parallel with per-job logs and a status table.")
+    parser.add_argument("commands", nargs="+", help="Commands to run, each quoted as one argument")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_WORKERS,
+                        help=f"Commands run at the same time (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--log-dir", default=LOG_DIR, help=f"Directory for the per-job logs (default: {LOG_DIR})")
+    args = parser.parse_args()
+
+    jobs = []
+    for command in args.commands:
+        words = shlex.split(command)
+        # Name each job after its last argument (the config file for trex-fitter)
+        jobs.append((os.path.splitext(os.path.basename(words[-1]))[0], words))
+    results = run_jobs(jobs, args.jobs, args.log_dir)
+    raise SystemExit(0 if all(result["status"] == "ok" for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
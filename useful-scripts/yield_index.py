@@ -0,0 +1,151 @@
+"""
+Yield index for the flattened ntuples.
+
+Collects the number of entries of the c_tagged and untagged trees of every
+ROOT file under flattenedNTuples/. Only the TTree metadata (fEntries) is read,
+never a basket, and the files are opened concurrently by a thread pool. The
+result is cached in <flattenedNTuples>/yield_index.json. A refresh only
+reopens files whose size or modification time changed, so refreshing the
+whole sample tree costs little more than one stat() per file.
+
+prepare-histograms.py takes its raw background and signal yields from this
+index, and the run_all_signals drivers take n_gen_ntuple from it. If uproot is
+not available, as in some fit containers, the cached index file is used as it
+is. Running this file directly refreshes the index and prints it:
+
+    python yield_index.py /path/to/flattenedNTuples
+"""
+import os
+import glob
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_NAME = 'yield_index.json'
+INDEX_VERSION = 1
+CATEGORIES = ['c_tagged', 'untagged']
+DEFAULT_WORKERS = 16
+
+
+def index_path(base_path):
+    return os.path.join(base_path, INDEX_NAME)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_entries(path):
+    """Entries of the category trees of one file, from the TTree metadata only."""
+    import uproot
+    with uproot.open(path) as root_file:
+        return {category: root_file[category].num_entries for category in CATEGORIES if category in root_file}
+
+
+def _load_cached(base_path):
+    try:
+        with open(index_path(base_path)) as handle:
+            index = json.load(handle)
+        if index.get('version') == INDEX_VERSION:
+            return index['files']
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def _save(base_path, files):
+    """Write the index next to the ntuples; a read-only sample area only costs the caching."""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=base_path, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump({'version': INDEX_VERSION, 'files': files}, handle, indent=1, sort_keys=True)
+        os.replace(tmp_path, index_path(base_path))
+    except OSError as e:
+        print(f"  WARNING: Could not write yield index to {index_path(base_path)}: {e}")
+
+
+def load_index(base_path, refresh=True, workers=DEFAULT_WORKERS):
+    """
+    Return {relative path: {'stamp': [size, mtime_ns], 'entries': {category: n}}}
+    for every ROOT file under base_path.
+
+    With refresh, new or modified files are (re)read and deleted ones dropped
+    before the index is returned and saved.
+    """
+    files = _load_cached(base_path)
+    if not refresh or not os.path.isdir(base_path):
+        return files
+
+    on_disk = sorted(os.path.relpath(path, base_path)
+                     for path in glob.glob(os.path.join(base_path, '**', '*.root'), recursive=True))
+    stamps = {relative: _stamp(os.path.join(base_path, relative)) for relative in on_disk}
+    stale = [relative for relative in on_disk
+             if relative not in files or files[relative]['stamp'] != stamps[relative]]
+    removed = [relative for relative in files if relative not in stamps]
+    if not stale and not removed:
+        return files
+    try:
+        # Only needed, and only imported, when something has to be read
+        import uproot  # noqa: F401
+    except ImportError:
+        print(f"  NOTE: uproot not available, using the cached yield index {index_path(base_path)} as is.")
+        return files
+
+    def read(relative):
+        try:
+            return _read_entries(os.path.join(base_path, relative))
+        except Exception as e:
+            print(f"  WARNING: Could not read entries of {relative}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(stale)))) as pool:
+        for relative, entries in zip(stale, pool.map(read, stale)):
+            if entries is None:
+                files.pop(relative, None)
+            else:
+                files[relative] = {'stamp': stamps[relative], 'entries': entries}
+    for relative in removed:
+        del files[relative]
+    _save(base_path, files)
+    return files
+
+
+def entries(files, relative_path, category):
+    """Entries of one category tree of one file, or None if it is not in the index."""
+    record = files.get(os.path.normpath(relative_path))
+    return record['entries'].get(category) if record else None
+
+
+def total_entries(files, relative_path):
+    """Entries summed over the category trees of one file, or None if it is not in the index."""
+    record = files.get(os.path.normpath(relative_path))
+    return sum(record['entries'].values()) if record else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh and print the yield index of the flattened ntuples.')
+    parser.add_argument('base_path', help='flattenedNTuples directory')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Files opened concurrently (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--no-refresh', action='store_true', help='Print the cached index without touching the ntuples')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    files = load_index(args.base_path, refresh=not args.no_refresh, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    print('-' * 83)
+    print(f"{'Ntuple':<50} | " + ' | '.join(f'{category:>12}' for category in CATEGORIES))
+    print('-' * 83)
+    for relative, record in sorted(files.items()):
+        counts = ' | '.join(f"{record['entries'].get(category, '-'):>12}" for category in CATEGORIES)
+        print(f'{relative:<50} | {counts}')
+    print('-' * 83)
+    print(f'{len(files)} files indexed in {elapsed * 1e3:.0f} ms -> {index_path(args.base_path)}')
+
+
+if __name__ == '__main__':
+    main()